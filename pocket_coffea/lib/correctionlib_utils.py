@@ -0,0 +1,13 @@
+from functools import lru_cache
+
+import correctionlib
+
+
+@lru_cache(maxsize=None)
+def load_correctionset(json_file):
+    '''
+    Load a correctionlib CorrectionSet from a json file.
+    The parsing of the json files is expensive: the loaded object is cached
+    so that it is done only once per worker process and shared by all the chunks.
+    '''
+    return correctionlib.CorrectionSet.from_file(json_file)
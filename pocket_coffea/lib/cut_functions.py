@@ -1,7 +1,7 @@
 import awkward as ak
 from .cut_definition import Cut
 from .triggers import get_trigger_mask
-import correctionlib
+from .correctionlib_utils import load_correctionset
 import numpy as np
 
 
@@ -69,7 +69,7 @@ def get_JetVetoMap_Mask(events, params, year, processor_params, sample, isMC, **
         & ((jets["neEmEF"]+jets["chEmEF"])<0.9) # Energy fraction not dominated by ECal
     )
     jets = jets[mask_for_VetoMap]
-    cset = correctionlib.CorrectionSet.from_file(
+    cset = load_correctionset(
         processor_params.jet_scale_factors.vetomaps[year]["file"]
     )
     corr = cset[processor_params.jet_scale_factors.vetomaps[year]["name"]]
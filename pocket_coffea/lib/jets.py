@@ -1,19 +1,23 @@
-import copy
 import importlib
 import gzip
 import cloudpickle
 
 import awkward as ak
 import numpy as np
-import correctionlib
 from coffea.jetmet_tools import  CorrectedMETFactory
 from ..lib.deltaR_matching import get_matching_pairs_indices, object_matching
+from ..parameters.jec_config import JECjsonFiles
+from .correctionlib_utils import load_correctionset
 
 
 def add_jec_variables(jets, event_rho, isMC=True):
     jets["pt_raw"] = (1 - jets.rawFactor) * jets.pt
     jets["mass_raw"] = (1 - jets.rawFactor) * jets.mass
-    jets["event_rho"] = ak.broadcast_arrays(event_rho, jets.pt)[0]
+    # rho is repeated per jet on the flat buffer: no intermediate broadcasted array
+    njets = ak.num(jets)
+    jets["event_rho"] = ak.unflatten(
+        np.repeat(ak.to_numpy(event_rho), ak.to_numpy(njets)), njets
+    )
     if isMC:
         jets["pt_gen"] = ak.values_astype(ak.fill_none(jets.matched_gen.pt, 0), np.float32)
     return jets
@@ -59,27 +63,34 @@ def jet_correction_correctionlib(
     jsonfile = JECjsonFiles[year][
         [t for t in ['AK4', 'AK8'] if typeJet.startswith(t)][0]
     ]
-    JECfile = correctionlib.CorrectionSet.from_file(jsonfile)
+    JECfile = load_correctionset(jsonfile)
     corr = JECfile.compound[f'{JECversion}_L1L2L3Res_{typeJet}']
 
     # until correctionlib handles jagged data natively we have to flatten and unflatten
     jets = events[Jet]
     jets['pt_raw'] = (1 - jets['rawFactor']) * jets['pt']
     jets['mass_raw'] = (1 - jets['rawFactor']) * jets['mass']
-    jets['rho'] = ak.broadcast_arrays(events.fixedGridRhoFastjetAll, jets.pt)[0]
-    j, nj = ak.flatten(jets), ak.num(jets)
+    nj = ak.num(jets)
+    # Only the needed columns are flattened, directly as numpy buffers.
+    # rho is repeated per jet on the flat buffer, without building
+    # an intermediate jagged array to be flattened again.
+    flat_eta = ak.to_numpy(ak.flatten(jets['eta']))
+    flat_pt_raw = ak.to_numpy(ak.flatten(jets['pt_raw']))
+    flat_rho = np.repeat(
+        ak.to_numpy(events.fixedGridRhoFastjetAll), ak.to_numpy(nj)
+    )
+    jets['rho'] = ak.unflatten(flat_rho, nj)
     flatCorrFactor = corr.evaluate(
-        np.array(j['area']),
-        np.array(j['eta']),
-        np.array(j['pt_raw']),
-        np.array(j['rho']),
+        ak.to_numpy(ak.flatten(jets['area'])),
+        flat_eta,
+        flat_pt_raw,
+        flat_rho,
     )
     corrFactor = ak.unflatten(flatCorrFactor, nj)
 
-    jets_corrected = copy.copy(jets)
-    jets_corrected['pt'] = jets['pt_raw'] * corrFactor
-    jets_corrected['mass'] = jets['mass_raw'] * corrFactor
-    jets_corrected['rho'] = jets['rho']
+    # New record view with the corrected fields, the others are shared with `jets`
+    jets_corrected = ak.with_field(jets, jets['pt_raw'] * corrFactor, "pt")
+    jets_corrected = ak.with_field(jets_corrected, jets['mass_raw'] * corrFactor, "mass")
 
     seed = events.event[0]
 
@@ -111,10 +122,11 @@ def jet_correction_correctionlib(
     if JERversion:
         sf = JECfile[f'{JERversion}_ScaleFactor_{typeJet}']
         res = JECfile[f'{JERversion}_PtResolution_{typeJet}']
-        j, nj = ak.flatten(jets_corrected), ak.num(jets_corrected)
-        scaleFactor_flat = sf.evaluate(j['eta'].to_numpy(), 'nom')
+        # The flat buffers of the JEC step are reused: eta and rho are
+        # unchanged and the corrected pt is pt_raw * corrFactor
+        scaleFactor_flat = sf.evaluate(flat_eta, 'nom')
         ptResolution_flat = res.evaluate(
-            j['eta'].to_numpy(), j['pt'].to_numpy(), j['rho'].to_numpy()
+            flat_eta, flat_pt_raw * flatCorrFactor, flat_rho
         )
         scaleFactor = ak.unflatten(scaleFactor_flat, nj)
         ptResolution = ak.unflatten(ptResolution_flat, nj)
@@ -178,9 +190,12 @@ def jet_correction_correctionlib(
         isMatched = ~ak.is_none(matched_jets.pt, axis=1)
         smearFactor = ak.where(isMatched, detSmear, stochSmear)
 
-        jets_smeared = copy.copy(jets_corrected)
-        jets_smeared['pt'] = jets_corrected['pt'] * smearFactor
-        jets_smeared['mass'] = jets_corrected['mass'] * smearFactor
+        jets_smeared = ak.with_field(
+            jets_corrected, jets_corrected['pt'] * smearFactor, "pt"
+        )
+        jets_smeared = ak.with_field(
+            jets_smeared, jets_corrected['mass'] * smearFactor, "mass"
+        )
 
         if verbose:
             print()
@@ -228,7 +243,7 @@ def jet_selection(events, jet_type, params, leptons_collection=""):
     # Lepton cleaning
     if leptons_collection != "":
         dR_jets_lep = jets.metric_table(events[leptons_collection])
-        mask_lepton_cleaning = ak.prod(dR_jets_lep > cuts["dr_lepton"], axis=2) == 1
+        mask_lepton_cleaning = ak.all(dR_jets_lep > cuts["dr_lepton"], axis=2)
 
     if jet_type == "Jet":
         # Selection on PUid. Only available in Run2 UL, thus we need to determine which sample we run over;
@@ -9,29 +9,33 @@ def lepton_selection(events, lepton_flavour, params):
 
     leptons = events[lepton_flavour]
     cuts = params.object_preselection[lepton_flavour]
-    # Requirements on pT and eta
-    passes_eta = abs(leptons.eta) < cuts["eta"]
-    passes_pt = leptons.pt > cuts["pt"]
+    # All the requirements are evaluated on the flat numpy buffers of the needed
+    # columns and combined in a single mask, unflattened only once at the end.
+    counts = ak.num(leptons)
+
+    def flat(column):
+        return ak.to_numpy(ak.flatten(column))
+
+    eta = flat(leptons.eta)
+    # Requirements on pT, eta and id
+    good_leptons = (
+        (np.abs(eta) < cuts["eta"])
+        & (flat(leptons.pt) > cuts["pt"])
+        & (flat(leptons[cuts['id']]) == True)
+    )
 
     if lepton_flavour == "Electron":
-        # Requirements on SuperCluster eta, isolation and id
-        etaSC = abs(leptons.deltaEtaSC + leptons.eta)
-        passes_SC = np.invert((etaSC >= 1.4442) & (etaSC <= 1.5660))
-        passes_iso = True
+        # Requirements on SuperCluster eta and isolation
+        etaSC = np.abs(flat(leptons.deltaEtaSC) + eta)
+        good_leptons &= np.invert((etaSC >= 1.4442) & (etaSC <= 1.5660))
         if "iso" in cuts.keys():
-            passes_iso = leptons.pfRelIso03_all < cuts["iso"]
-        passes_id = leptons[cuts['id']] == True
-
-        good_leptons = passes_eta & passes_pt & passes_SC & passes_iso & passes_id
+            good_leptons &= flat(leptons.pfRelIso03_all) < cuts["iso"]
 
     elif lepton_flavour == "Muon":
-        # Requirements on isolation and id
-        passes_iso = leptons.pfRelIso04_all < cuts["iso"]
-        passes_id = leptons[cuts['id']] == True
+        # Requirements on isolation
+        good_leptons &= flat(leptons.pfRelIso04_all) < cuts["iso"]
 
-        good_leptons = passes_eta & passes_pt & passes_iso & passes_id
-
-    return leptons[good_leptons]
+    return leptons[ak.unflatten(good_leptons, counts)]
 
 def soft_lepton_selection(events, lepton_flavour, params):
 
@@ -72,28 +76,23 @@ def get_dilepton(electrons, muons, transverse=False):
         "mass": 0.,
         "charge": 0.,
     }
-    
-    leptons = ak.pad_none(ak.with_name(ak.concatenate([ muons[:, 0:2], electrons[:, 0:2]], axis=1), "PtEtaPhiMCandidate"), 2)
-    nlep =  ak.num(leptons[~ak.is_none(leptons, axis=1)])
-    ll = leptons[:,0] + leptons[:,1]
+
+    leptons = ak.with_name(ak.concatenate([ muons[:, 0:2], electrons[:, 0:2]], axis=1), "PtEtaPhiMCandidate")
+    # The number of leptons is read from the offsets before padding
+    # and the dilepton mask is computed only once for all the fields
+    has_dilepton = ak.num(leptons) == 2
+    leptons = ak.pad_none(leptons, 2)
+    l1, l2 = leptons[:,0], leptons[:,1]
+    ll = l1 + l2
 
     for var in fields.keys():
-        fields[var] = ak.where(
-            (nlep == 2),
-            getattr(ll, var),
-            fields[var]
-        )
-        
-    fields["deltaR"] = ak.where(
-        (nlep == 2), leptons[:,0].delta_r(leptons[:,1]), -1)
-    fields["deltaPhi"] = ak.where(
-        (nlep == 2), abs(leptons[:,0].delta_phi(leptons[:,1])), -1)
-    fields["deltaEta"] = ak.where(
-        (nlep == 2), abs(leptons[:,0].eta - leptons[:,1].eta), -1)
-    fields["l1phi"] = ak.where(
-        (nlep == 2), leptons[:,0].phi, -1)
-    fields["l2phi"] = ak.where(
-        (nlep == 2), leptons[:,1].phi, -1)
+        fields[var] = ak.where(has_dilepton, getattr(ll, var), fields[var])
+
+    fields["deltaR"] = ak.where(has_dilepton, l1.delta_r(l2), -1)
+    fields["deltaPhi"] = ak.where(has_dilepton, abs(l1.delta_phi(l2)), -1)
+    fields["deltaEta"] = ak.where(has_dilepton, abs(l1.eta - l2.eta), -1)
+    fields["l1phi"] = ak.where(has_dilepton, l1.phi, -1)
+    fields["l2phi"] = ak.where(has_dilepton, l2.phi, -1)
 
     if transverse:
         fields["eta"] = ak.zeros_like(fields["pt"])
@@ -125,17 +124,7 @@ def get_diboson(dileptons, MET, transverse=False):
 
 def get_charged_leptons(electrons, muons, charge, mask):
 
-    fields = {
-        "pt": None,
-        "eta": None,
-        "phi": None,
-        "mass": None,
-        "energy": None,
-        "charge": None,
-        "x": None,
-        "y": None,
-        "z": None,
-    }
+    fields = ["pt", "eta", "phi", "mass", "energy", "charge", "x", "y", "z"]
 
     nelectrons = ak.num(electrons)
     nmuons = ak.num(muons)
@@ -143,48 +132,38 @@ def get_charged_leptons(electrons, muons, charge, mask):
     mask_mumu = mask & ((nelectrons + nmuons) == 2) & (nmuons == 2)
     mask_emu = mask & ((nelectrons + nmuons) == 2) & (nelectrons == 1) & (nmuons == 1)
 
-    for var in fields.keys():
-        if var in ["eta", "phi"]:
-            default = ak.from_iter(len(electrons) * [[-9.0]])
-        else:
-            default = ak.from_iter(len(electrons) * [[-999.9]])
-        if not var in ["energy", "x", "y", "z"]:
-            fields[var] = ak.where(
-                mask_ee, electrons[var][electrons.charge == charge], default
-            )
-            fields[var] = ak.where(
-                mask_mumu, muons[var][muons.charge == charge], fields[var]
+    # The charge selection and the event categorization do not depend
+    # on the field: they are computed once for all the fields.
+    ele_charge_mask = electrons.charge == charge
+    mu_charge_mask = muons.charge == charge
+    ele_pick = electrons[ele_charge_mask]
+    mu_pick = muons[mu_charge_mask]
+    use_ele = mask_ee | (mask_emu & ak.any(ele_charge_mask, axis=1))
+    # In the emu case the muon takes precedence if both leptons have the requested charge
+    use_mu = mask_mumu | (mask_emu & ak.any(mu_charge_mask, axis=1))
+
+    # One-element-per-event defaults, built from flat numpy buffers
+    default_angle = ak.unflatten(np.full(len(electrons), -9.0), 1)
+    default = ak.unflatten(np.full(len(electrons), -999.9), 1)
+
+    # getattr works both for the stored fields and for the
+    # behavior properties (energy, x, y, z)
+    charged_leptons = ak.zip(
+        {
+            var: ak.flatten(
+                ak.where(
+                    use_mu,
+                    getattr(mu_pick, var),
+                    ak.where(
+                        use_ele,
+                        getattr(ele_pick, var),
+                        default_angle if var in ["eta", "phi"] else default,
+                    ),
+                )
             )
-            fields[var] = ak.where(
-                mask_emu & ak.any(electrons.charge == charge, axis=1),
-                electrons[var][electrons.charge == charge],
-                fields[var],
-            )
-            fields[var] = ak.where(
-                mask_emu & ak.any(muons.charge == charge, axis=1),
-                muons[var][muons.charge == charge],
-                fields[var],
-            )
-            fields[var] = ak.flatten(fields[var])
-        else:
-            fields[var] = ak.where(
-                mask_ee, getattr(electrons, var)[electrons.charge == charge], default
-            )
-            fields[var] = ak.where(
-                mask_mumu, getattr(muons, var)[muons.charge == charge], fields[var]
-            )
-            fields[var] = ak.where(
-                mask_emu & ak.any(electrons.charge == charge, axis=1),
-                getattr(electrons, var)[electrons.charge == charge],
-                fields[var],
-            )
-            fields[var] = ak.where(
-                mask_emu & ak.any(muons.charge == charge, axis=1),
-                getattr(muons, var)[muons.charge == charge],
-                fields[var],
-            )
-            fields[var] = ak.flatten(fields[var])
-
-    charged_leptons = ak.zip(fields, with_name="PtEtaPhiMCandidate")
+            for var in fields
+        },
+        with_name="PtEtaPhiMCandidate",
+    )
 
     return charged_leptons
@@ -1,6 +1,6 @@
 import numpy as np
 import awkward as ak
-import correctionlib
+from .correctionlib_utils import load_correctionset
 
 
 def get_ele_sf(
@@ -13,7 +13,7 @@ def get_ele_sf(
     electronSF = params["lepton_scale_factors"]["electron_sf"]
 
     if key in ['reco', 'id']:
-        electron_correctionset = correctionlib.CorrectionSet.from_file(
+        electron_correctionset = load_correctionset(
             electronSF.JSONfiles[year]["file"]
         )
         map_name = electronSF.JSONfiles[year]["name"]
@@ -25,35 +25,23 @@ def get_ele_sf(
 
         # translate the `year` key into the corresponding key in the correction file provided by the EGM-POG
         year_pog = electronSF["era_mapping"][year]
-        
+
+        # The flat inputs are converted to numpy once and shared by the nominal and up/down evaluations
+        eta_np, pt_np = eta.to_numpy(), pt.to_numpy()
         if year in ["2023_preBPix", "2023_postBPix"]:
             # Starting from 2023 SFs require the phi:
             if key == 'reco' and pt_region == 'pt_lt_20':
                 # It also appears that for RecoBelow20 SFs the eta must be positive (absolute value).
-                eta_np = np.abs(eta.to_numpy())
-            else:
-                eta_np = eta.to_numpy()
-                
-            sf = electron_correctionset[map_name].evaluate(
-                year_pog, "sf", sfname, eta_np, pt.to_numpy(),  phi.to_numpy()
-            )
-            sfup = electron_correctionset[map_name].evaluate(
-                year_pog, "sfup", sfname, eta_np, pt.to_numpy(), phi.to_numpy()
-            )
-            sfdown = electron_correctionset[map_name].evaluate(
-                year_pog, "sfdown", sfname, eta_np, pt.to_numpy(), phi.to_numpy()
-            )
+                eta_np = np.abs(eta_np)
+            inputs = (eta_np, pt_np, phi.to_numpy())
         else:
-            # All other eras do not need phi:    
-            sf = electron_correctionset[map_name].evaluate(
-                year_pog, "sf", sfname, eta.to_numpy(), pt.to_numpy()
-            )
-            sfup = electron_correctionset[map_name].evaluate(
-                year_pog, "sfup", sfname, eta.to_numpy(), pt.to_numpy()
-            )
-            sfdown = electron_correctionset[map_name].evaluate(
-                year_pog, "sfdown", sfname, eta.to_numpy(), pt.to_numpy()
-            )
+            # All other eras do not need phi:
+            inputs = (eta_np, pt_np)
+
+        corr = electron_correctionset[map_name]
+        sf = corr.evaluate(year_pog, "sf", sfname, *inputs)
+        sfup = corr.evaluate(year_pog, "sfup", sfname, *inputs)
+        sfdown = corr.evaluate(year_pog, "sfdown", sfname, *inputs)
         # The unflattened arrays are returned in order to have one row per event.
         return (
             ak.unflatten(sf, counts),
@@ -62,31 +50,25 @@ def get_ele_sf(
         )
     elif key == 'trigger':
 
-        electron_correctionset = correctionlib.CorrectionSet.from_file(
+        electron_correctionset = load_correctionset(
             electronSF.trigger_sf[year]["file"]
         )
         map_name = electronSF.trigger_sf[year]["name"]
+        corr = electron_correctionset[map_name]
+        pt_np, eta_np = pt.to_numpy(), eta.to_numpy()
 
         output = {}
         for variation in variations:
             if variation == "nominal":
-                output[variation] = [
-                    electron_correctionset[map_name].evaluate(
-                        variation, pt.to_numpy(), eta.to_numpy()
-                    )
-                ]
+                output[variation] = [corr.evaluate(variation, pt_np, eta_np)]
             else:
                 # Nominal sf==1
-                nominal = np.ones_like(pt.to_numpy())
+                nominal = np.ones_like(pt_np)
                 # Systematic variations
                 output[variation] = [
                     nominal,
-                    electron_correctionset[map_name].evaluate(
-                        f"{variation}Up", pt.to_numpy(), eta.to_numpy()
-                    ),
-                    electron_correctionset[map_name].evaluate(
-                        f"{variation}Down", pt.to_numpy(), eta.to_numpy()
-                    ),
+                    corr.evaluate(f"{variation}Up", pt_np, eta_np),
+                    corr.evaluate(f"{variation}Down", pt_np, eta_np),
                 ]
             for i, sf in enumerate(output[variation]):
                 output[variation][i] = ak.unflatten(sf, counts)
@@ -100,21 +82,18 @@ def get_mu_sf(params, year, pt, eta, counts, key=''):
     '''
     muonSF = params["lepton_scale_factors"]["muon_sf"]
 
-    muon_correctionset = correctionlib.CorrectionSet.from_file(
+    muon_correctionset = load_correctionset(
         muonSF.JSONfiles[year]['file']
     )
     
     sfName = muonSF.sf_name[year][key]
-    
-    sf = muon_correctionset[sfName].evaluate(
-        np.abs(eta.to_numpy()), pt.to_numpy(), "nominal"
-    )
-    sfup = muon_correctionset[sfName].evaluate(
-        np.abs(eta.to_numpy()), pt.to_numpy(), "systup"
-    )
-    sfdown = muon_correctionset[sfName].evaluate(
-        np.abs(eta.to_numpy()), pt.to_numpy(), "systdown"
-    )
+    corr = muon_correctionset[sfName]
+    # The flat inputs are converted to numpy once and shared by the nominal and up/down evaluations
+    abseta_np, pt_np = np.abs(eta.to_numpy()), pt.to_numpy()
+
+    sf = corr.evaluate(abseta_np, pt_np, "nominal")
+    sfup = corr.evaluate(abseta_np, pt_np, "systup")
+    sfdown = corr.evaluate(abseta_np, pt_np, "systdown")
     
     # The unflattened arrays are returned in order to have one row per event.
     return (
@@ -276,7 +255,7 @@ def sf_btag(params, jets, year, njets, variations=["central"]):
     '''
     btagSF = params.jet_scale_factors.btagSF[year]
     btag_discriminator = params.btagging.working_point[year]["btagging_algorithm"]
-    cset = correctionlib.CorrectionSet.from_file(btagSF.file)
+    cset = load_correctionset(btagSF.file)
     corr = cset[btagSF.name]
 
     flavour = ak.to_numpy(ak.flatten(jets.hadronFlavour))
@@ -353,7 +332,7 @@ def sf_btag(params, jets, year, njets, variations=["central"]):
 def sf_btag_calib(params, sample, year, njets, jetsHt):
     '''Correction to btagSF computing by comparing the inclusive shape without btagSF and with btagSF in 2D:
     njets-JetsHT bins. Each sample/year has a different correction stored in the correctionlib format.'''
-    cset = correctionlib.CorrectionSet.from_file(
+    cset = load_correctionset(
         params.btagSF_calibration[year]["file"]
     )
     corr = cset[params.btagSF_calibration[year]["name"]]
@@ -375,7 +354,7 @@ def sf_ctag(params, jets, year, njets, variations=["central"]):
 
     ctagSF = params.jet_scale_factors.ctagSF[year]
     ctagger = params.ctagging.working_point[year]["tagger"]
-    cset = correctionlib.CorrectionSet.from_file(ctagSF.SF_file)
+    cset = load_correctionset(ctagSF.SF_file)
 
     #print(list(cset.keys()))
     #print(list(cset.items()))
@@ -423,7 +402,7 @@ def sf_ctag_calib(params, dataset, year, njets, jetsHt):
     which was  derived for V+2J phase space. It may not be suitable for other analyses.
     '''
     ctagSF = params.jet_scale_factors.ctagSF[year]
-    cset = correctionlib.CorrectionSet.from_file(ctagSF.Calib_file)
+    cset = load_correctionset(ctagSF.Calib_file)
 
     corr = cset["ctagSF_norm_correction"]
     w = corr.evaluate(dataset, ak.to_numpy(njets), ak.to_numpy(jetsHt))
@@ -444,7 +423,7 @@ def sf_jet_puId(params, jets, year, njets):
     genJetId_mask = ak.flatten(jets.genJetIdx >= 0)
 
     # GenGet matching by index, needs some checkes
-    cset = correctionlib.CorrectionSet.from_file(
+    cset = load_correctionset(
         params.jet_scale_factors.jet_puId[year]["file"]
     )
     corr = cset[params.jet_scale_factors.jet_puId[year]["name"]]
@@ -485,7 +464,7 @@ def sf_pileup_reweight(params, events, year):
     puFile = params.pileupJSONfiles[year]['file']
     puName = params.pileupJSONfiles[year]['name']
 
-    puWeightsJSON = correctionlib.CorrectionSet.from_file(puFile)
+    puWeightsJSON = load_correctionset(puFile)
 
     nPu = events.Pileup.nTrueInt.to_numpy()
     sf = puWeightsJSON[puName].evaluate(nPu, 'nominal')
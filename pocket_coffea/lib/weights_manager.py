@@ -1,9 +1,13 @@
 from dataclasses import dataclass
 import inspect
+import sys
 import awkward as ak
 import numpy as np
 from collections.abc import Callable
-from collections import defaultdict
+from typing import List, Optional
+from collections import defaultdict, Counter
+from itertools import chain
+from functools import partial
 
 from coffea.analysis_tools import Weights
 
@@ -23,6 +27,48 @@ from .scale_factors import (
 )
 
 
+# Weights and variations predefined by the WeightsManager.
+# They are built once at import, as they are checked for every weight of every chunk.
+_AVAILABLE_WEIGHTS = frozenset(
+    [
+        'genWeight',
+        'signOf_genWeight',
+        'lumi',
+        'XS',
+        'pileup',
+        'sf_ele_reco',
+        'sf_ele_id',
+        'sf_ele_trigger',
+        'sf_mu_id',
+        'sf_mu_iso',
+        'sf_mu_trigger',
+        'sf_btag',
+        'sf_btag_calib',
+        'sf_ctag',
+        'sf_ctag_calib',
+        'sf_jet_puId',
+        'sf_L1prefiring',
+    ]
+)
+
+_AVAILABLE_VARIATIONS = frozenset(
+    [
+        "nominal",
+        "pileup",
+        "sf_ele_reco",
+        "sf_ele_id",
+        "sf_ele_trigger",
+        "sf_mu_id",
+        "sf_mu_iso",
+        "sf_mu_trigger",
+        "sf_jet_puId",
+        "sf_L1prefiring",
+        "sf_btag",
+        "sf_ctag",
+    ]
+)
+
+
 @dataclass
 class WeightCustom:
     '''
@@ -35,6 +81,9 @@ class WeightCustom:
     - function:  function defining the weights of the events chunk.
                  signuture (params, events, size, metadata:dict, shape_variation:str)
     - variations: list of variations
+    - columns: (optional) list of per-event columns needed by the function.
+               If set, the function receives a dictionary {column: numpy array}
+               with only these columns in place of the full events array.
 
     The function must return the weights in the following format::
 
@@ -47,10 +96,12 @@ class WeightCustom:
 
     name: str
     function: Callable  # The function to call
+    columns: Optional[List[str]] = None  # Per-event columns passed as numpy arrays
 
     def serialize(self, src_code=False):
         out = {
             "name": self.name,
+            "columns": self.columns,
             "function": {
                 "name": self.function.__name__,
                 "module": self.function.__module__,
@@ -63,6 +114,28 @@ class WeightCustom:
         return out
 
 
+def _rescale_variations(sfs, central, variations):
+    '''
+    Rescale in place the up and down variations of a multi-variation
+    SF dictionary ({variation: [nominal, up, down]}) by the central SF.
+    This avoids double counting of the central SF when the variations are added
+    as separate entries in the Weights object.
+
+    The rescaled variations are written in a single preallocated (2, Nvariations, Nevents)
+    buffer: each row is filled directly by the division, without intermediate copies.
+    '''
+    if len(variations) == 0:
+        return
+    central_sf = ak.to_numpy(sfs[central][0])
+    buffer = np.empty((2, len(variations), len(central_sf)), dtype=np.float64)
+    up, down = buffer[0], buffer[1]
+    for i, var in enumerate(variations):
+        np.divide(ak.to_numpy(sfs[var][1]), central_sf, out=up[i])
+        np.divide(ak.to_numpy(sfs[var][2]), central_sf, out=down[i])
+        sfs[var][1] = up[i]
+        sfs[var][2] = down[i]
+
+
 class WeightsManager:
     '''
     The WeightManager class handles the
@@ -81,48 +154,14 @@ class WeightsManager:
         '''
         Predefine weights for CMS Run2 UL analysis.
         '''
-        return set(
-            [
-                'genWeight',
-                'signOf_genWeight',
-                'lumi',
-                'XS',
-                'pileup',
-                'sf_ele_reco',
-                'sf_ele_id',
-                'sf_ele_trigger',
-                'sf_mu_id',
-                'sf_mu_iso',
-                'sf_mu_trigger',
-                'sf_btag',
-                'sf_btag_calib',
-                'sf_ctag',
-                'sf_ctag_calib',
-                'sf_jet_puId',
-                'sf_L1prefiring',
-            ]
-        )
+        return _AVAILABLE_WEIGHTS
 
     @classmethod
     def available_variations(cls):
         '''
         Predefine weights variations for CMS Run2 UL analysis.
         '''
-        out = [
-            "nominal",
-            "pileup",
-            "sf_ele_reco",
-            "sf_ele_id",
-            "sf_ele_trigger",
-            "sf_mu_id",
-            "sf_mu_iso",
-            "sf_mu_trigger",
-            "sf_jet_puId",
-            "sf_L1prefiring",
-            "sf_btag",
-            "sf_ctag"
-        ]
-        return set(out)
+        return _AVAILABLE_VARIATIONS
 
     def __init__(
         self,
@@ -149,41 +188,63 @@ class WeightsManager:
         self._weightsIncl = Weights(size, storeIndividual)
         self._weightsByCat = {}
         # Dictionary keeping track of which modifier can be applied to which region
-        self._available_modifiers_inclusive = []
-        self._available_modifiers_bycat = defaultdict(list)
-
+        self._available_modifiers_inclusive = set()
+        self._available_modifiers_bycat = defaultdict(set)
+
+        # Only the weights requested more than once (e.g. in several categories)
+        # are kept in the cache: the others are computed and added directly.
+        _weights_count = Counter(
+            w if isinstance(w, str) else w.name
+            for w in chain(
+                self.weightsConf["inclusive"],
+                *self.weightsConf["bycategory"].values(),
+            )
+        )
         _weightsCache = {}
 
+        def __get_weight(key, compute):
+            if _weights_count[key] < 2:
+                return compute()
+            if key not in _weightsCache:
+                _weightsCache[key] = compute()
+            return _weightsCache[key]
+
         def __add_weight(w, weight_obj):
             installed_modifiers = []
             # If the Weight is a name look into the predefined weights
             if isinstance(w, str):
-                if w not in WeightsManager.available_weights():
+                if w not in _AVAILABLE_WEIGHTS:
                     # it means that the weight is defined in a processor.
                     # The configurator has already checked that it is defined somewhere.
                     # DO nothing
-                    return
-                if w not in _weightsCache:
-                    _weightsCache[w] = self._compute_weight(
-                        w, events, self._shape_variation
-                    )
-                for we in _weightsCache[w]:
+                    return installed_modifiers
+                weights = __get_weight(
+                    w,
+                    lambda: self._compute_weight(w, events, self._shape_variation),
+                )
+                for we in weights:
                     weight_obj.add(*we)
                     if len(we) > 2:
                         # the weights has variations
-                        installed_modifiers += [we[0] + "Up", we[0] + "Down"]
+                        installed_modifiers += [sys.intern(we[0] + "Up"), sys.intern(we[0] + "Down")]
             # If the Weight is a Custom weight just run the function
             elif isinstance(w, WeightCustom):
-                if w.name not in _weightsCache:
-                    _weightsCache[w.name] = w.function(
-                        self.params, events, self.size, metadata, self._shape_variation
-                    )
-                for we in _weightsCache[w.name]:
+                weights = __get_weight(
+                    w.name,
+                    lambda: w.function(
+                        self.params,
+                        self._get_custom_weight_input(w, events),
+                        self.size,
+                        metadata,
+                        self._shape_variation,
+                    ),
+                )
+                for we in weights:
                     # print(we)
                     weight_obj.add(*we)
                     if len(we) > 2:
                         # the weights has variations
-                        installed_modifiers += [we[0] + "Up", we[0] + "Down"]
+                        installed_modifiers += [sys.intern(we[0] + "Up"), sys.intern(we[0] + "Down")]
             return installed_modifiers
 
         # Compute first the inclusive weights
@@ -191,7 +252,7 @@ class WeightsManager:
             # print(f"Adding weight {w} inclusively")
             modifiers = __add_weight(w, self._weightsIncl)
             # Save the list of availbale modifiers
-            self._available_modifiers_inclusive += modifiers
+            self._available_modifiers_inclusive.update(modifiers)
 
         # Now weights for dedicated categories
         if self.weightsConf["is_split_bycat"]:
@@ -203,18 +264,67 @@ class WeightsManager:
                 self._weightsByCat[cat] = Weights(size, storeIndividual)
                 for w in ws:
                     modifiers = __add_weight(w, self._weightsByCat[cat])
-                    self._available_modifiers_bycat[cat] += modifiers
+                    self._available_modifiers_bycat[cat].update(modifiers)
 
-        # make the variations unique
-        self._available_modifiers_inclusive = set(self._available_modifiers_inclusive)
-        self._available_modifiers_bycat = {
-            k: set(v) for k, v in self._available_modifiers_bycat.items()
-        }
+        # The modifiers are collected in sets, so they are already unique.
+        # Their names are interned, as they are the keys of the get_weight lookups.
+        self._available_modifiers_inclusive = frozenset(self._available_modifiers_inclusive)
+        self._available_modifiers_bycat = dict(self._available_modifiers_bycat)
 
         # print("Weights modifiers inclusive", self._available_modifiers_inclusive)
         # print("Weights modifiers bycat", self._available_modifiers_bycat)
         # Clear the cache once the Weights objects have been added
         _weightsCache.clear()
+        # Resolve once the weight computation for each (category, modifier)
+        self._build_dispatch_table()
+
+    def _build_dispatch_table(self):
+        '''
+        The inclusive/bycategory logic of `get_weight` is resolved once for all the valid
+        (category, modifier) pairs, storing the function returning the corresponding weight.
+        The category `None` identifies the inclusive weight.
+        '''
+        incl = self._weightsIncl
+        mods_incl = self._available_modifiers_inclusive
+        self._dispatch = {(None, None): incl.weight}
+        for mod in mods_incl:
+            self._dispatch[(None, mod)] = partial(incl.weight, modifier=mod)
+
+        for cat, bycat in self._weightsByCat.items():
+            mods_bycat = self._available_modifiers_bycat[cat]
+            # Nominal both for the inclusive and the split weights
+            self._dispatch[(cat, None)] = lambda bycat=bycat: (
+                incl.weight() * bycat.weight()
+            )
+            # Modifiers available only inclusively: modified inclusive and nominal bycat
+            for mod in mods_incl - mods_bycat:
+                self._dispatch[(cat, mod)] = lambda bycat=bycat, mod=mod: (
+                    incl.weight(modifier=mod) * bycat.weight()
+                )
+            # Modifiers available only bycategory: nominal inclusive and modified bycat
+            for mod in mods_bycat - mods_incl:
+                self._dispatch[(cat, mod)] = lambda bycat=bycat, mod=mod: (
+                    incl.weight() * bycat.weight(modifier=mod)
+                )
+
+    @staticmethod
+    def _get_custom_weight_input(weight, events):
+        '''
+        Events input of a WeightCustom function: the full events array or,
+        if the weight declares its `columns`, only those per-event columns
+        materialized once as flat numpy arrays.
+        '''
+        if weight.columns is None:
+            return events
+        columns = {}
+        for c in weight.columns:
+            column = events[c]
+            if column.ndim != 1:
+                raise ValueError(
+                    f"Column {c} requested by the WeightCustom {weight.name} is not a flat per-event column"
+                )
+            columns[c] = ak.to_numpy(column)
+        return columns
 
     def _compute_weight(self, weight_name, events, shape_variation):
         '''
@@ -276,12 +386,7 @@ class WeightsManager:
                     variations=["nominal"] + sf_ele_trigger_vars,
                 )
                 # BE AWARE --> COFFEA HACK FOR MULTIPLE VARIATIONS
-                for var in sf_ele_trigger_vars:
-                    # Rescale the up and down variation by the nominal one to
-                    # avoid double counting of the central SF when adding the weights
-                    # as separate entries in the Weights object.
-                    triggersf[var][1] = triggersf[var][1] / triggersf["nominal"][0]
-                    triggersf[var][2] = triggersf[var][2] / triggersf["nominal"][0]
+                _rescale_variations(triggersf, "nominal", sf_ele_trigger_vars)
             else:
                 # Only the nominal if there is a shape variation
                 triggersf = sf_ele_trigger(
@@ -308,12 +413,7 @@ class WeightsManager:
                     variations=["central"] + btag_vars,
                 )
                 # BE AWARE --> COFFEA HACK FOR MULTIPLE VARIATIONS
-                for var in btag_vars:
-                    # Rescale the up and down variation by the central one to
-                    # avoid double counting of the central SF when adding the weights
-                    # as separate entries in the Weights object.
-                    btagsf[var][1] = btagsf[var][1] / btagsf["central"][0]
-                    btagsf[var][2] = btagsf[var][2] / btagsf["central"][0]
+                _rescale_variations(btagsf, "central", btag_vars)
 
             elif "JES_" in shape_variation:
                 # Compute the special version of the btagSF for JES variation
@@ -365,15 +465,8 @@ class WeightsManager:
                     njets=events.nJetGood,
                     variations=["central"] + ctag_vars,
                 )
-
-                for var in ctag_vars:
-                    #print("ctag_var", var)
-                    #print(ctagsf[var])
-                    # Rescale the up and down variation by the central one to
-                    # avoid double counting of the central SF when adding the weights
-                    # as separate entries in the Weights object.
-                    ctagsf[var][1] = ctagsf[var][1] / ctagsf["central"][0]
-                    ctagsf[var][2] = ctagsf[var][2] / ctagsf["central"][0]
+                # BE AWARE --> COFFEA HACK FOR MULTIPLE VARIATIONS
+                _rescale_variations(ctagsf, "central", ctag_vars)
 
             else:
                 ctagsf = sf_ctag(
@@ -432,41 +525,16 @@ class WeightsManager:
         The requested variation==modifier must be available or in the
         inclusive weights, or in the bycategory weights.
         '''
-        if (
-            category == None
-            or self.weightsConf["is_split_bycat"] == False
-            or category not in self._weightsByCat
-        ):
-            # return the inclusive weight
-            if modifier != None and modifier not in self._available_modifiers_inclusive:
+        if category not in self._weightsByCat:
+            # The category has no bycategory configuration: return the inclusive weight
+            category = None
+        weight_fn = self._dispatch.get((category, modifier))
+        if weight_fn is None:
+            if category is None:
                 raise ValueError(
                     f"Modifier {modifier} not available in inclusive category"
                 )
-            return self._weightsIncl.weight(modifier=modifier)
-
-        elif category and self.weightsConf["is_split_bycat"] == True:
-            # Check if this category has a bycategory configuration
-            if modifier == None:
-                # Get the nominal both for the inclusive and the split weights
-                return (
-                    self._weightsIncl.weight() * self._weightsByCat[category].weight()
-                )
-            else:
-                mod_incl = modifier in self._available_modifiers_inclusive
-                mod_bycat = modifier in self._available_modifiers_bycat[category]
-
-                if mod_incl and not mod_bycat:
-                    # Get the modified inclusive and nominal bycat
-                    return (
-                        self._weightsIncl.weight(modifier=modifier)
-                        * self._weightsByCat[category].weight()
-                    )
-                elif not mod_incl and mod_bycat:
-                    # Get the nominal by cat and modified inclusive
-                    return self._weightsIncl.weight() * self._weightsByCat[
-                        category
-                    ].weight(modifier=modifier)
-                else:
-                    raise ValueError(
-                        f"Modifier {modifier} not available in category {category}"
-                    )
+            raise ValueError(
+                f"Modifier {modifier} not available in category {category}"
+            )
+        return weight_fn()
@@ -1,28 +1,250 @@
 import os
 import sys
 import json
+import hashlib
+import math
+import tempfile
+import dataclasses
 from copy import deepcopy
 from pprint import pprint, pformat
 import cloudpickle
 from collections import defaultdict
+from functools import lru_cache, partial
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 import inspect
 import logging
-from omegaconf import OmegaConf
+import numpy as np
+from omegaconf import OmegaConf, DictConfig, ListConfig
 
 from ..lib.cut_definition import Cut
-from ..lib.categorization import StandardSelection, CartesianSelection
+from ..lib.categorization import StandardSelection, CartesianSelection, MultiCut
 from ..parameters.cuts import passthrough
 from ..lib.weights_manager import WeightCustom
 from ..lib.hist_manager import Axis, HistConf
 from ..utils import build_jets_calibrator
+from ..__meta__ import __version__
 
 from pprint import PrettyPrinter
 
+# orjson is used, if available, to speed up the parsing of the (large) datasets json files
+# and the dump of the configuration
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _sanitize_json(obj):
+    '''Non-finite floats are not valid json: they are dumped as null, as orjson does.
+    Numpy arrays and scalars are converted to python objects.'''
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: _sanitize_json(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_sanitize_json(v) for v in obj]
+    if isinstance(obj, np.ndarray):
+        return _sanitize_json(obj.tolist())
+    return obj
+
+
+def _json_dump_stdlib(obj, f):
+    f.write(json.dumps(_sanitize_json(obj), indent=2, allow_nan=False).encode("utf-8"))
+
+
+def _json_dump_orjson(obj, f):
+    f.write(
+        orjson.dumps(
+            obj,
+            option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+        )
+    )
+
+
+if orjson is not None:
+    _json_loads = orjson.loads
+    _json_dump = _json_dump_orjson
+else:
+    _json_loads = json.loads
+    _json_dump = _json_dump_stdlib
+
+
 def format(data, indent=0, width=80, depth=None, compact=True, sort_dicts=True):
     pp = PrettyPrinter(indent=indent, width=width, depth=depth, compact=compact, sort_dicts=sort_dicts)
     return pp.pformat(data)
 
 
+def _config_names(wcfg):
+    '''Iterate over all the names listed in a weights/variations configuration'''
+    for section in [wcfg["common"], *wcfg.get("bysample", {}).values()]:
+        yield from section.get("inclusive", [])
+        for names in section.get("bycategory", {}).values():
+            yield from names
+
+
+def _check_available(names, available, kind):
+    '''Check that all the names (of the string entries) are available in the workflow.
+    All the missing names are reported at once.'''
+    missing = {w for w in names if isinstance(w, str)} - available
+    if missing:
+        print(f"{kind.capitalize()}s {sorted(missing)} not available in the workflow")
+        raise Exception(f"Wrong {kind} configuration")
+
+
+def _intern(name):
+    '''Intern the string names, as they are used as keys in many lookups. Other objects are returned unchanged.'''
+    return sys.intern(name) if type(name) is str else name
+
+
+def _weight_key(w):
+    '''Hashable key of a weight: the WeightCustom dataclass is not hashable,
+    so it is identified by the same fields compared by its equality.'''
+    if isinstance(w, WeightCustom):
+        return (w.name, w.function, tuple(w.columns) if w.columns is not None else None)
+    return w
+
+
+def _load_datasets_json(json_dataset):
+    '''Load and parse a datasets json file'''
+    with open(json_dataset, "rb") as f:
+        return _json_loads(f.read())
+
+
+class _UncacheableInput(Exception):
+    '''An input of the Configurator cannot be identified reliably in the cache key'''
+
+
+def _code_names(code):
+    '''Global names referenced by a code object and by the code objects nested in it'''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+
+class _StableRepr:
+    '''
+    Representation of the configuration objects which does not depend on the process,
+    used to build the key of the Configurator cache:
+    - functions are identified by module and qualified name, the content of their source file,
+      their defaults, closure cells and the global objects they reference (recursively);
+    - classes by module and qualified name and the content of the source files of their MRO;
+    - the Cuts by their fields (their id contains an address-based hash);
+    - sets and dicts are sorted.
+    Functions and classes whose source file cannot be read (e.g. defined in a notebook)
+    raise _UncacheableInput: a change in their code would not change the key.
+    '''
+
+    def __init__(self):
+        self._files = {}
+        self._parents = set()
+
+    def file_hash(self, path):
+        if path not in self._files:
+            with open(path, "rb") as f:
+                self._files[path] = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        return self._files[path]
+
+    def module(self, module):
+        path = getattr(module, "__file__", None)
+        if path is not None and path.endswith(".py") and os.path.isfile(path):
+            return f"module {module.__name__}@{self.file_hash(path)}"
+        return f"module {module.__name__}"
+
+    def cls(self, cls):
+        out = []
+        for c in cls.__mro__:
+            module = sys.modules.get(c.__module__)
+            if c.__module__ == "builtins":
+                out.append(c.__qualname__)
+            elif module is None or getattr(module, "__file__", None) is None:
+                raise _UncacheableInput(f"the source of the class {c.__module__}.{c.__qualname__} cannot be read")
+            else:
+                out.append(f"{c.__module__}.{c.__qualname__}:{self.module(module)}")
+        return "class(" + ", ".join(out) + ")"
+
+    def function(self, func):
+        code = func.__code__
+        if not os.path.isfile(code.co_filename):
+            raise _UncacheableInput(f"the source of the function {func.__module__}.{func.__qualname__} cannot be read")
+        closure = [cell.cell_contents for cell in func.__closure__ or ()]
+        referenced_globals = {
+            name: func.__globals__[name] for name in _code_names(code) if name in func.__globals__
+        }
+        return (
+            f"function {func.__module__}.{func.__qualname__}@{self.file_hash(code.co_filename)}"
+            f"({self(func.__defaults__)}, {self(func.__kwdefaults__)}, "
+            f"{self(closure)}, {self(referenced_globals)})"
+        )
+
+    def __call__(self, obj):
+        if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+            return repr(obj)
+        # Guard against reference cycles, e.g. recursive functions
+        if id(obj) in self._parents:
+            return "<cycle>"
+        self._parents.add(id(obj))
+        try:
+            return self._repr(obj)
+        finally:
+            self._parents.discard(id(obj))
+
+    def _repr(self, obj):
+        if isinstance(obj, (DictConfig, ListConfig)):
+            return self(OmegaConf.to_container(obj))
+        if isinstance(obj, dict):
+            return "{" + ", ".join(sorted(f"{self(k)}: {self(v)}" for k, v in obj.items())) + "}"
+        if isinstance(obj, (list, tuple)):
+            return "[" + ", ".join(self(v) for v in obj) + "]"
+        if isinstance(obj, (set, frozenset)):
+            return "{" + ", ".join(sorted(self(v) for v in obj)) + "}"
+        if isinstance(obj, np.ndarray):
+            return self(obj.tolist())
+        if isinstance(obj, StandardSelection):
+            return self({cat: {obj.cut_dict[c] for c in cuts} for cat, cuts in obj.categories.items()})
+        if isinstance(obj, CartesianSelection):
+            return self((obj.multicuts, obj.common_cats))
+        if isinstance(obj, MultiCut):
+            return self((obj.name, obj.cuts, obj.cuts_names))
+        if isinstance(obj, partial):
+            return f"partial({self(obj.func)}, {self(obj.args)}, {self(obj.keywords)})"
+        if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+            # Only the fields set by the user: the Cut._id is derived from the others
+            return type(obj).__qualname__ + self(
+                {f.name: getattr(obj, f.name) for f in dataclasses.fields(obj) if f.init}
+            )
+        if inspect.ismodule(obj):
+            return self.module(obj)
+        if inspect.isclass(obj):
+            return self.cls(obj)
+        if inspect.ismethod(obj):
+            return f"method({self(obj.__func__)}, {self(obj.__self__)})"
+        if inspect.isfunction(obj):
+            return self.function(obj)
+        if inspect.isroutine(obj):
+            # Builtin and compiled functions
+            return f"{getattr(obj, '__module__', None)}.{getattr(obj, '__qualname__', obj.__name__)}"
+        if hasattr(obj, "__dict__"):
+            return type(obj).__qualname__ + self(vars(obj))
+        return repr(obj)
+
+
+@lru_cache(maxsize=None)
+def _available_weights(workflow):
+    '''Set of the weights available in the workflow class, computed once per class.'''
+    return frozenset(workflow.available_weights())
+
+
+@lru_cache(maxsize=None)
+def _available_variations(workflow):
+    '''Set of the variations available in the workflow class, computed once per class.'''
+    return frozenset(workflow.available_variations())
+
+
 class Configurator:
     '''
     Main class driving the configuration of a PocketCoffea analysis.
@@ -81,6 +303,8 @@ class Configurator:
         self.subsamples_list = []  # List of subsamples (for internal checks)
         self.subsamples_reversed_map = {}  # Map of subsample: sample
         self.total_samples_list = []  # List of subsamples and inclusive samples names
+        self._subsamples_set = frozenset()
+        self._total_samples_set = frozenset()
         self.has_subsamples = {}
 
         self.years = []
@@ -108,9 +332,25 @@ class Configurator:
 
         self.loaded = False
 
-    def load(self):
+    def load(self, cache_dir=None):
         '''This function loads the configuration for samples/weights/variations and creates
-        the necessary objects for the processor to use. It also loads the workflow'''
+        the necessary objects for the processor to use. It also loads the workflow.
+
+        If `cache_dir` is given, the loaded Configurator is cached in that folder,
+        identified by a hash of its inputs (see `inputs_hash`). Following calls with the
+        same inputs restore it from the cache. If some inputs cannot be identified
+        reliably, the cache is not used.'''
+        if cache_dir is not None:
+            try:
+                cache_file = os.path.join(cache_dir, f"configurator_{self.inputs_hash()}.pkl")
+            except _UncacheableInput as e:
+                print(f"The Configurator cannot be cached: {e}")
+                cache_dir = None
+        if cache_dir is not None:
+            if os.path.exists(cache_file):
+                self.load_from_cache(cache_file)
+                return
+
         self.load_datasets()
         self.load_subsamples()
 
@@ -121,10 +361,11 @@ class Configurator:
         # in the objects needed in the processors
         self.load_cuts_and_categories(self.skim_cfg, self.preselections_cfg, self.categories_cfg)
 
+        # The bycategory lists are created only for the categories with weights
         self.weights_config = {
             s: {
                 "inclusive": [],
-                "bycategory": {c: [] for c in self.categories.keys()},
+                "bycategory": defaultdict(list),
                 "is_split_bycat": False,
             }
             for s in self.samples
@@ -138,8 +379,8 @@ class Configurator:
         # sample:category structure
         self.variations_config = {
             s: {
-                "weights": {c: [] for c in self.categories.keys()},
-                "shape": {c: [] for c in self.categories.keys()},
+                "weights": {c: [] for c in self._category_keys},
+                "shape": {c: [] for c in self._category_keys},
             }
             for s in self.samples
         }
@@ -150,22 +391,20 @@ class Configurator:
         self.load_variations_config(self.variations_cfg["shape"], variation_type="shape")
             
         # Collecting overall list of available weights and shape variations per sample
-        self.available_weights_variations = {s: ["nominal"] for s in self.samples}
-        self.available_shape_variations = {s: [] for s in self.samples}
+        # The variations are collected directly in sets to make them unique
+        self.available_weights_variations = {}
+        self.available_shape_variations = {}
         for sample in self.samples:
             # Weights variations
-            for cat, vars in self.variations_config[sample]["weights"].items():
-                self.available_weights_variations[sample] += vars
+            weights_vars = {"nominal"}
+            for vars in self.variations_config[sample]["weights"].values():
+                weights_vars.update(vars)
+            self.available_weights_variations[sample] = list(weights_vars)
             # Shape variations
-            for cat, vars in self.variations_config[sample]["shape"].items():
-                self.available_shape_variations[sample] += vars
-            # make them unique
-            self.available_weights_variations[sample] = list(
-                set(self.available_weights_variations[sample])
-            )
-            self.available_shape_variations[sample] = list(
-                set(self.available_shape_variations[sample])
-            )
+            shape_vars = set()
+            for vars in self.variations_config[sample]["shape"].values():
+                shape_vars.update(vars)
+            self.available_shape_variations[sample] = list(shape_vars)
             
         # Columns configuration
         self.load_columns_config(self.columns_cfg)
@@ -183,25 +422,88 @@ class Configurator:
 
         # Mark the configurator as loaded
         self.loaded = True
-        
 
-    def load_datasets(self):
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # The pickle is written to a temporary file and moved in place,
+            # so that concurrent jobs never read a partially written cache
+            tmp_file = tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False)
+            try:
+                with tmp_file:
+                    cloudpickle.dump(self, tmp_file)
+                os.replace(tmp_file.name, cache_file)
+            except BaseException:
+                # e.g. an object which cannot be pickled: no temporary file is left behind
+                os.unlink(tmp_file.name)
+                raise
+
+    def inputs_hash(self):
+        '''Hash of all the inputs defining the Configurator, used to identify its cached version.
+        It is stable across processes and it includes the PocketCoffea version, the content of
+        the source files of the functions and classes in the configuration (and of the ones they
+        reference), and the modification time and size of the datasets json files.
+        Raises _UncacheableInput if the source of a function or class cannot be read.'''
+        datasets_files = []
         for json_dataset in self.datasets_cfg["jsons"]:
-            ds_dict = json.load(open(json_dataset))
-            ds_filter = self.datasets_cfg.get("filter", None)
+            stat = os.stat(json_dataset)
+            datasets_files.append((os.path.abspath(json_dataset), stat.st_mtime_ns, stat.st_size))
+        inputs = (
+            __version__,
+            self.workflow,
+            self.workflow_options,
+            OmegaConf.to_yaml(self.parameters),
+            self.datasets_cfg,
+            datasets_files,
+            self.skim_cfg,
+            self.preselections_cfg,
+            self.categories_cfg,
+            self.weights_cfg,
+            self.variations_cfg,
+            self.variables,
+            self.columns_cfg,
+            self.save_skimmed_files,
+        )
+        return hashlib.blake2b(_StableRepr()(inputs).encode("utf-8"), digest_size=16).hexdigest()
+
+    def load_from_cache(self, cache_file):
+        '''Restore the loaded configuration from a Configurator pickled by `load`'''
+        with open(cache_file, "rb") as f:
+            cached = cloudpickle.load(f)
+        self.__dict__.update(cached.__dict__)
+        # The processor instance is recreated to refer to this Configurator
+        self.load_workflow()
+        # The jet calibration factory is not part of the cache
+        if not os.path.exists(self.parameters.jets_calibration.factory_file):
+            build_jets_calibrator.build(self.parameters.jets_calibration,
+                                        filter_years=self.years)
+
+
+    def load_datasets(self):
+        ds_filter = self.datasets_cfg.get("filter", None)
+        if ds_filter != None:
+            # The filter is prepared once for all the datasets entries
+            samples_ok = frozenset(ds_filter["samples"]) if "samples" in ds_filter else None
+            samples_exclude = frozenset(ds_filter.get("samples_exclude", []))
+            years_ok = frozenset(ds_filter["year"]) if "year" in ds_filter else None
+
+            def pass_filter(metadata):
+                if samples_ok is not None and metadata["sample"] not in samples_ok:
+                    return False
+                if metadata["sample"] in samples_exclude:
+                    return False
+                if years_ok is not None and metadata["year"] not in years_ok:
+                    return False
+                return True
+
+        # The json files are read and parsed concurrently, then merged in the configured order
+        jsons = self.datasets_cfg["jsons"]
+        with ThreadPoolExecutor(max_workers=min(16, max(1, len(jsons)))) as pool:
+            ds_dicts = list(pool.map(_load_datasets_json, jsons))
+
+        for ds_dict in ds_dicts:
             if ds_filter != None:
                 for key, ds in ds_dict.items():
-                    pass_filter = True
-                    if "samples" in ds_filter:
-                        if ds["metadata"]["sample"] not in ds_filter["samples"]:
-                            pass_filter = False
-                    if "samples_exclude" in ds_filter:
-                        if ds["metadata"]["sample"] in ds_filter["samples_exclude"]:
-                            pass_filter = False
-                    if "year" in ds_filter:
-                        if ds["metadata"]["year"] not in ds_filter["year"]:
-                            pass_filter = False
-                    if pass_filter:
+                    if pass_filter(ds["metadata"]):
                         self.filesets[key] = ds
             else:
                 self.filesets.update(ds_dict)
@@ -211,18 +513,23 @@ class Configurator:
             print("File set is empty: please check you dataset definition...")
             raise Exception("Wrong filesets configuration")
         else:
+            # Ordered sets (dict keys) keep the datasets order without quadratic list lookups
+            datasets = dict.fromkeys(self.datasets)
+            samples = dict.fromkeys(self.samples)
+            years = dict.fromkeys(self.years)
+            eras = dict.fromkeys(self.eras)
             for name, d in self.filesets.items():
                 m = d["metadata"]
-                if name not in self.datasets:
-                    self.datasets.append(name)
-                if m["sample"] not in self.samples:
-                    self.samples.append(m["sample"])
-                if m["year"] not in self.years:
-                    self.years.append(m["year"])
-                if 'era' in m.keys():
-                    if (m["era"]) not in self.eras:
-                        self.eras.append(m["era"])
-                        
+                datasets[name] = None
+                samples[_intern(m["sample"])] = None
+                years[m["year"]] = None
+                if 'era' in m:
+                    eras[m["era"]] = None
+            self.datasets = list(datasets)
+            self.samples = list(samples)
+            self.years = list(years)
+            self.eras = list(eras)
+
 
     def load_subsamples(self):
         # subsamples configuration
@@ -238,6 +545,9 @@ class Configurator:
 
         # Complete list of samples and subsamples
         self.total_samples_list = list(set(self.samples + self.subsamples_list))
+        # Sets used for the membership checks
+        self._subsamples_set = frozenset(self.subsamples_list)
+        self._total_samples_set = frozenset(self.total_samples_list)
 
         # Now saving the subsamples definition cuts
         for sample in self.samples:
@@ -264,25 +574,19 @@ class Configurator:
         Each cut is identified by a unique id (see Cut class definition)'''
         # If the skim, preselection and categories list are empty, append a `passthrough` Cut
 
-        if len(skim) == 0:
+        if not skim:
             skim.append(passthrough)
-        if len(preselections) == 0:
+        if not preselections:
             preselections.append(passthrough)
 
-        if categories == {}:
+        if not categories:
             categories["baseline"] = [passthrough]
 
-        for sk in skim:
-            if not isinstance(sk, Cut):
-                print("Please define skim, preselections and cuts as Cut objects")
-                raise Exception("Wrong categories/cuts configuration")
-            self.skim.append(sk)
-
-        for pres in preselections:
-            if not isinstance(pres, Cut):
-                print("Please define skim, preselections and cuts as Cut objects")
-                raise Exception("Wrong categories/cuts configuration")
-            self.preselections.append(pres)
+        if not all(isinstance(c, Cut) for c in chain(skim, preselections)):
+            print("Please define skim, preselections and cuts as Cut objects")
+            raise Exception("Wrong categories/cuts configuration")
+        self.skim += skim
+        self.preselections += preselections
 
         # Now saving the categories
         if isinstance(categories, dict):
@@ -292,38 +596,51 @@ class Configurator:
             self.categories = categories
         elif isinstance(categories, CartesianSelection):
             self.categories = categories
+        # The categories names are cached, as they are needed for every sample
+        self._category_keys = tuple(_intern(c) for c in self.categories.keys())
 
     def load_weights_config(self, wcfg):
         '''This function loads the weights definition and prepares a list of
         weights to be applied for each sample and category'''
         # Get the list of statically available weights defined in the workflow
-        available_weights = self.workflow.available_weights()
+        available_weights = _available_weights(self.workflow)
         # Read the config and save the list of weights names for each sample (and category if needed)
         if "common" not in wcfg:
             print("Weights configuration error: missing 'common' weights key")
             raise Exception("Wrong weight configuration")
+        # Check at once that all the weights are available
+        _check_available(_config_names(wcfg), available_weights, "weight")
+        # The bycategory weights are collected lazily: check explicitly the categories names
+        categories = set(self._category_keys)
+        for section in [wcfg["common"], *wcfg.get("bysample", {}).values()]:
+            for cat in section.get("bycategory", {}):
+                if cat not in categories:
+                    print(f"Requested missing category {cat} in the weights configuration")
+                    raise Exception("Wrong weight configuration")
+        # Shadow sets of the inclusive weights of each sample, used for the duplicates checks
+        inclusive = {
+            sample: {_weight_key(w) for w in wsample["inclusive"]}
+            for sample, wsample in self.weights_config.items()
+        }
         # common/inclusive weights
         for w in wcfg["common"]["inclusive"]:
-            if isinstance(w, str):
-                if w not in available_weights:
-                    print(f"Weight {w} not available in the workflow")
-                    raise Exception("Wrong weight configuration")
+            w = _intern(w)
             # do now check if the weights is not string but custom
-            for wsample in self.weights_config.values():
+            wkey = _weight_key(w)
+            for sample, wsample in self.weights_config.items():
                 # add the weight to all the categories and samples
                 wsample["inclusive"].append(w)
+                inclusive[sample].add(wkey)
 
         if "bycategory" in wcfg["common"]:
             for cat, weights in wcfg["common"]["bycategory"].items():
                 for w in weights:
-                    if isinstance(w, str):
-                        if w not in available_weights:
-                            print(f"Weight {w} not available in the workflow")
-                            raise Exception("Wrong weight configuration")
-                    for wsample in self.weights_config.values():
+                    w = _intern(w)
+                    wkey = _weight_key(w)
+                    for sample, wsample in self.weights_config.items():
                         wsample["is_split_bycat"] = True
                         # looping on all the samples for this category
-                        if w in wsample["inclusive"]:
+                        if wkey in inclusive[sample]:
                             raise Exception(
                                 """Error! Trying to include weight {w}
                             by category, but it is already included inclusively!"""
@@ -341,21 +658,16 @@ class Configurator:
 
                 if "inclusive" in s_wcfg:
                     for w in s_wcfg["inclusive"]:
-                        if isinstance(w, str):
-                            if w not in available_weights:
-                                print(f"Weight {w} not available in the workflow")
-                                raise Exception("Wrong weight configuration")
+                        w = _intern(w)
                         # append only to the specific sample
                         self.weights_config[sample]["inclusive"].append(w)
+                        inclusive[sample].add(_weight_key(w))
 
                 if "bycategory" in s_wcfg:
                     for cat, weights in s_wcfg["bycategory"].items():
                         for w in weights:
-                            if isinstance(w, str):
-                                if w not in available_weights:
-                                    print(f"Weight {w} not available in the workflow")
-                                    raise Exception("Wrong weight configuration")
-                            if w in self.weights_config[sample]["inclusive"]:
+                            w = _intern(w)
+                            if _weight_key(w) in inclusive[sample]:
                                 raise Exception(
                                     f"""Error! Trying to include weight {w}
                                 by category, but it is already included inclusively!"""
@@ -368,34 +680,37 @@ class Configurator:
         weights to be applied for each sample and category'''
 
         # Get the list of statically available variations defined in the workflow
-        available_variations = self.workflow.available_variations()
+        available_variations = _available_variations(self.workflow)
         # Read the config and save the list of variations names for each sample (and category if needed)
+        # The lists keep the configuration order, while the shadow sets are used for the duplicates checks
+        included = {
+            sample: {cat: set(wcat) for cat, wcat in wsample[variation_type].items()}
+            for sample, wsample in self.variations_config.items()
+        }
 
         if "common" not in wcfg:
             print("Variation configuration error: missing 'common' weights key")
             raise Exception("Wrong variation configuration")
+        # Check at once that all the variations are available
+        _check_available(_config_names(wcfg), available_variations, "variation")
         # common/inclusive variations
         for w in wcfg["common"]["inclusive"]:
-            if isinstance(w, str):
-                if w not in available_variations:
-                    print(f"Variation {w} not available in the workflow")
-                    raise Exception("Wrong variation configuration")
+            w = _intern(w)
             # do now check if the variations is not string but custom
-            for wsample in self.variations_config.values():
+            for sample, wsample in self.variations_config.items():
                 # add the variation to all the categories and samples
-                for wcat in wsample[variation_type].values():
+                for cat, wcat in wsample[variation_type].items():
                     wcat.append(w)
+                    included[sample][cat].add(w)
 
         if "bycategory" in wcfg["common"]:
             for cat, variations in wcfg["common"]["bycategory"].items():
                 for w in variations:
-                    if isinstance(w, str):
-                        if w not in available_variations:
-                            print(f"Variation {w} not available in the workflow")
-                            raise Exception("Wrong variation configuration")
-                    for wsample in self.variations_config.values():
-                        if w not in wsample[variation_type][cat]:
+                    w = _intern(w)
+                    for sample, wsample in self.variations_config.items():
+                        if w not in included[sample][cat]:
                             wsample[variation_type][cat].append(w)
+                            included[sample][cat].add(w)
 
         # Now look at specific samples configurations
         if "bysample" in wcfg:
@@ -407,29 +722,23 @@ class Configurator:
                     raise Exception("Wrong variation configuration")
                 if "inclusive" in s_wcfg:
                     for w in s_wcfg["inclusive"]:
-                        if isinstance(w, str):
-                            if w not in available_variations:
-                                print(f"Variation {w} not available in the workflow")
-                                raise Exception("Wrong variation configuration")
+                        w = _intern(w)
                         # append only to the specific sample
-                        for wcat in self.variations_config[sample][
+                        for cat, wcat in self.variations_config[sample][
                             variation_type
-                        ].values():
-                            if w not in wcat:
+                        ].items():
+                            if w not in included[sample][cat]:
                                 wcat.append(w)
+                                included[sample][cat].add(w)
 
                 if "bycategory" in s_wcfg:
                     for cat, variation in s_wcfg["bycategory"].items():
                         for w in variation:
-                            if isinstance(w, str):
-                                if w not in available_variations:
-                                    print(
-                                        f"Variation {w} not available in the workflow"
-                                    )
-                                    raise Exception("Wrong variation configuration")
+                            w = _intern(w)
                             self.variations_config[sample][variation_type][cat].append(
                                 w
                             )
+                            included[sample][cat].add(w)
 
     def load_columns_config(self, wcfg):
         if wcfg == None:
@@ -437,9 +746,9 @@ class Configurator:
         for sample in self.samples:
             if self.has_subsamples[sample]:
                 for sub in self.subsamples[sample]:
-                    self.columns[f"{sample}__{sub}"] = {c: [] for c in self.categories.keys()}
+                    self.columns[f"{sample}__{sub}"] = {c: [] for c in self._category_keys}
             else:
-                self.columns[sample] = {c: [] for c in self.categories.keys()}
+                self.columns[sample] = {c: [] for c in self._category_keys}
         # common/inclusive variations
         if "common" in wcfg:
             if "inclusive" in wcfg["common"]:
@@ -459,46 +768,37 @@ class Configurator:
 
         # Now look at specific samples configurations
         if "bysample" in wcfg:
-            for sample, s_wcfg in wcfg["bysample"].items():
-                if sample not in self.total_samples_list:
+            # Resolve once the columns dictionaries targeted by each configured sample.
+            # Columns manager uses the subsample_list with the full name
+            targets = {}
+            for sample in wcfg["bysample"]:
+                if sample not in self._total_samples_set:
                     print(
                         f"Requested missing sample {sample} in the columns configuration"
                     )
                     raise Exception("Wrong columns configuration")
+                if sample in self._subsamples_set or not self.has_subsamples[sample]:
+                    # Add only to the specific subsample or to the pure sample
+                    targets[sample] = (self.columns[sample],)
+                else:
+                    # If it was added to the general one: include in all subsamples
+                    targets[sample] = tuple(
+                        self.columns[f"{sample}__{subs}"] for subs in self.subsamples[sample]
+                    )
+
+            for sample, s_wcfg in wcfg["bysample"].items():
                 if "inclusive" in s_wcfg:
                     for w in s_wcfg["inclusive"]:
-                        # If the the sample 
-                        if sample not in self.subsamples_list:
-                            # the sample name is not a subsample, we need to check if it has subsamples
-                            if not self.has_subsamples[sample]:
-                            # add column only to the pure sample
-                                for wcat in self.columns[sample].values():
-                                    if w not in wcat:
-                                        wcat.append(w)
-                                       
-                            else: # the sample has subsamples
-                                # If it was added to the general one: include in all subsamples
-                                for subs in self.subsamples[sample]:
-                                    # Columns manager uses the subsample_list with the full name
-                                    for wcat in self.columns[f"{sample}__{subs}"].values():
-                                        if w not in wcat:
-                                            wcat.append(w)
-                        else:
-                            # Add only to the specific subsample
-                            for wcat in self.columns[sample].values():
+                        for wsample in targets[sample]:
+                            for wcat in wsample.values():
                                 if w not in wcat:
                                     wcat.append(w)
 
                 if "bycategory" in s_wcfg:
                     for cat, columns in s_wcfg["bycategory"].items():
                         for w in columns:
-                            if sample in self.subsamples_list:
-                                self.columns[sample][cat].append(w)
-                            elif self.has_subsamples[sample]:
-                                for subs in self.subsamples[sample].keys():
-                                    self.columns[subs][cat].append(w)
-                            else:
-                                self.columns[sample][cat].append(w)
+                            for wsample in targets[sample]:
+                                wsample[cat].append(w)
         #prune the empty categories
         
     def perform_checks(self):
@@ -508,22 +808,55 @@ class Configurator:
                 raise Exception("genWeight and signOf_genWeight cannot be used together\nPlease fix your weights configuration")
     
     def filter_dataset(self, nfiles):
-        filtered_filesets = {}
-        filtered_datasets = []
-        for dataset_name, ds in self.filesets.items():
-            ds["files"] = ds["files"][0:nfiles]
-            filtered_filesets[dataset_name] = ds
-            filtered_datasets.append(dataset_name)
-        self.filesets = filtered_filesets
-        self.datasets = filtered_datasets
+        # The filesets are limited in place: the datasets list is unchanged
+        for ds in self.filesets.values():
+            if len(ds["files"]) > nfiles:
+                ds["files"] = ds["files"][:nfiles]
 
     def load_workflow(self):
         self.processor_instance = self.workflow(cfg=self)
 
-    def save_config(self, output):
+    def save_config(self, output, save_json=True, save_pkl=True):
+        '''Save the configuration in the output folder: the parameters yaml dump,
+        and optionally the serialized configuration in json (`save_json=True`)
+        and the pickled Configurator object (`save_pkl=True`).'''
         if not self.loaded:
             print("The configurator is not loaded yet, please load it before saving the configuration")
             return
+        # add the parameters as yaml in a separate file
+        with open(os.path.join(output, "parameters_dump.yaml"), "w") as pf:
+            # Materialize the interpolations
+            pf.write(OmegaConf.to_yaml(self.parameters))
+
+        if save_json:
+            self.save_json_config(output)
+        if save_pkl:
+            self.save_pickle(output)
+
+    def save_json_config(self, output):
+        '''Save the serialized configuration in the config.json file of the output folder'''
+        output_cfg = os.path.join(output, "config.json")
+        print("Saving config file to " + output_cfg)
+        with open(output_cfg, "wb") as f:
+            _json_dump(self._build_ocfg(), f)
+
+    def save_pickle(self, output):
+        '''Pickle the configurator object in order to be able to reproduce completely the configuration'''
+        with open(os.path.join(output, "configurator.pkl"), "wb") as f:
+            cloudpickle.dump(self, f)
+
+    def _build_ocfg(self):
+        '''Build the serialized (json-compatible) version of the configuration'''
+        # The same objects (e.g. a WeightCustom used in many samples and categories)
+        # are serialized only once
+        serialized = {}
+
+        def serialize(obj):
+            out = serialized.get(id(obj))
+            if out is None:
+                out = serialized[id(obj)] = obj.serialize()
+            return out
+
         ocfg = {}
         ocfg["datasets"] = {
             "names": self.datasets,
@@ -534,17 +867,16 @@ class Configurator:
         subsamples_cuts = self.subsamples
         dump_subsamples = {}
         for sample, subsamples in subsamples_cuts.items():
-            dump_subsamples[sample] = {}
-            dump_subsamples[sample] = subsamples.serialize()
+            dump_subsamples[sample] = serialize(subsamples)
         ocfg["datasets"]["subsamples"] = dump_subsamples
 
         skim_dump = []
         presel_dump = []
         cats_dump = {}
         for sk in self.skim:
-            skim_dump.append(sk.serialize())
+            skim_dump.append(serialize(sk))
         for pre in self.preselections:
-            presel_dump.append(pre.serialize())
+            presel_dump.append(serialize(pre))
 
         ocfg["skim"] = skim_dump
         ocfg["preselections"] = presel_dump
@@ -561,45 +893,34 @@ class Configurator:
         ocfg["weights"] = {}
         for sample, weights in self.weights_config.items():
             out = {"bycategory": {}, "inclusive": []}
-            for cat, catw in weights["bycategory"].items():
+            for cat in self._category_keys:
+                catw = weights["bycategory"].get(cat, [])
                 out["bycategory"][cat] = []
                 for w in catw:
                     if isinstance(w, WeightCustom):
-                        out["bycategory"][cat].append(w.serialize())
+                        out["bycategory"][cat].append(serialize(w))
                     else:
                         out["bycategory"][cat].append(w)
             for w in weights["inclusive"]:
                 if isinstance(w, WeightCustom):
-                    out["inclusive"].append(w.serialize())
+                    out["inclusive"].append(serialize(w))
                 else:
                     out["inclusive"].append(w)
             ocfg["weights"][sample] = out
 
         ocfg["variations"] = self.variations_config
         ocfg["variables"] = {
-            key: val.serialize() for key, val in self.variables.items()
+            key: serialize(val) for key, val in self.variables.items()
         }
 
         ocfg["columns"] = {
-            s: {c: [] for c in self.categories} for s in self.total_samples_list
+            s: {c: [] for c in self._category_keys} for s in self.total_samples_list
         }
         for sample, columns in self.columns.items():
             for cat, cols in columns.items():
                 for col in cols:
                     ocfg["columns"][sample][cat].append(col.__dict__)
-
-        # add the parameters as yaml in a separate file
-        with open(os.path.join(output, "parameters_dump.yaml"), "w") as pf:
-            # Materialize the interpolations
-            pf.write(OmegaConf.to_yaml(self.parameters))
-
-        # Save the serialized configuration in json
-        output_cfg = os.path.join(output, "config.json")
-        print("Saving config file to " + output_cfg)
-        json.dump(ocfg, open(output_cfg, "w"), indent=2)
-        # Pickle the configurator object in order to be able to reproduce completely the configuration
-        cloudpickle.dump(self, open(os.path.join(output, "configurator.pkl"), "wb"))
-        # dump also the parameters
+        return ocfg
 
     def __repr__(self):
         if not self.loaded:
@@ -1,6 +1,7 @@
 from contextlib import contextmanager
 import importlib.util
 import os
+import logging
 import sys
 from typing import List, Optional
 import awkward
@@ -41,7 +42,8 @@ def load_config(cfg, do_load=False, do_logging=True, save_config=True, outputdir
         if do_load:
             config.load()
         if do_logging:
-            logging.info(config)
+            # The (large) representation of the Configurator is built only if INFO messages are emitted
+            logging.info("%s", config)
         if save_config and outputdir is not None:
             config.save_config(outputdir)
     except AttributeError as e:
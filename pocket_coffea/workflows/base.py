@@ -314,7 +314,8 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
         Identifiers of the weights available thorugh this processor.
         By default they are all the weights defined in the WeightsManager
         '''
-        return WeightsManager.available_weights()
+        # Copy the predefined weights: the WeightsManager returns a frozenset
+        return set(WeightsManager.available_weights())
 
     def compute_weights(self, variation):
         '''
@@ -568,7 +569,8 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
         Identifiers of the weights variabtions available thorugh this processor.
         By default they are all the weights defined in the WeightsManager
         '''
-        vars = WeightsManager.available_variations()
+        # Copy the predefined variations: the WeightsManager returns a frozenset
+        vars = set(WeightsManager.available_variations())
         available_jet_types = [
             "AK4PFchs",
             "AK4PFPuppi",
@@ -0,0 +1,328 @@
+import os
+import sys
+import json
+import subprocess
+import textwrap
+import importlib
+import pytest
+from omegaconf import OmegaConf
+
+from pocket_coffea.utils import configurator
+from pocket_coffea.utils.configurator import Configurator
+from pocket_coffea.lib.cut_definition import Cut
+from pocket_coffea.lib.columns_manager import ColOut
+from pocket_coffea.parameters.cuts import passthrough
+
+
+class DummyWorkflow:
+    '''Minimal workflow exposing the available weights and variations'''
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    @classmethod
+    def available_weights(cls):
+        return {"genWeight", "pileup", "sf_btag"}
+
+    @classmethod
+    def available_variations(cls):
+        return {"nominal", "pileup", "sf_btag"}
+
+
+@pytest.fixture
+def datasets_json(tmp_path):
+    datasets = {
+        f"{sample}_2018": {
+            "metadata": {"sample": sample, "year": "2018", "isMC": "True", "nevents": 100},
+            "files": [f"/store/{sample}_{i}.root" for i in range(3)],
+        }
+        for sample in ["TTTo2L2Nu", "DYJetsToLL"]
+    }
+    path = tmp_path / "datasets.json"
+    path.write_text(json.dumps(datasets))
+    return str(path)
+
+
+@pytest.fixture
+def make_configurator(tmp_path, datasets_json):
+    factory_file = tmp_path / "jets_calibrator.pkl.gz"
+    factory_file.write_bytes(b"")
+
+    def make(weights=None, variations=None, categories=None, subsamples=None, columns=None):
+        if weights is None:
+            weights = {
+                "common": {
+                    "inclusive": ["genWeight", "pileup"],
+                    "bycategory": {"2b": ["sf_btag"]},
+                }
+            }
+        if variations is None:
+            variations = {"weights": {"common": {"inclusive": ["pileup"]}}}
+        return Configurator(
+            workflow=DummyWorkflow,
+            parameters=OmegaConf.create({"jets_calibration": {"factory_file": str(factory_file)}}),
+            datasets={"jsons": [datasets_json], **({"subsamples": subsamples} if subsamples else {})},
+            skim=[],
+            preselections=[],
+            categories=categories if categories is not None else {"1b": [passthrough], "2b": [passthrough]},
+            weights=weights,
+            variations=variations,
+            variables={},
+            columns=columns,
+        )
+
+    return make
+
+
+def test_load(make_configurator):
+    cfg = make_configurator()
+    cfg.load()
+    assert cfg.loaded
+    assert cfg.samples == ["TTTo2L2Nu", "DYJetsToLL"]
+    assert cfg.weights_config["TTTo2L2Nu"]["inclusive"] == ["genWeight", "pileup"]
+    assert cfg.weights_config["TTTo2L2Nu"]["bycategory"]["2b"] == ["sf_btag"]
+
+
+def test_missing_weights(make_configurator, capsys):
+    cfg = make_configurator(
+        weights={
+            "common": {"inclusive": ["genWeight", "missing_a"], "bycategory": {"2b": ["missing_b"]}},
+            "bysample": {"TTTo2L2Nu": {"inclusive": ["missing_c"]}},
+        }
+    )
+    with pytest.raises(Exception, match="Wrong weight configuration"):
+        cfg.load()
+    # All the missing weights are reported at once
+    assert "['missing_a', 'missing_b', 'missing_c'] not available" in capsys.readouterr().out
+
+
+def test_missing_variations(make_configurator, capsys):
+    cfg = make_configurator(
+        variations={
+            "weights": {
+                "common": {"inclusive": ["pileup", "missing_a"]},
+                "bysample": {"DYJetsToLL": {"bycategory": {"1b": ["missing_b"]}}},
+            }
+        }
+    )
+    with pytest.raises(Exception, match="Wrong variation configuration"):
+        cfg.load()
+    assert "['missing_a', 'missing_b'] not available" in capsys.readouterr().out
+
+
+def test_unknown_weights_category(make_configurator, capsys):
+    cfg = make_configurator(
+        weights={
+            "common": {"inclusive": ["genWeight"]},
+            "bysample": {"TTTo2L2Nu": {"bycategory": {"3b": ["sf_btag"]}}},
+        }
+    )
+    with pytest.raises(Exception, match="Wrong weight configuration"):
+        cfg.load()
+    assert "Requested missing category 3b in the weights configuration" in capsys.readouterr().out
+
+
+def test_columns_subsamples(make_configurator):
+    jet, jetgood, electron, muon = (
+        ColOut("Jet", ["pt"]), ColOut("JetGood", ["eta"]), ColOut("Electron", ["pt"]), ColOut("Muon", ["pt"])
+    )
+    cfg = make_configurator(
+        subsamples={"TTTo2L2Nu": {"ee": [passthrough], "mumu": [passthrough]}},
+        columns={
+            "common": {"inclusive": [jet]},
+            "bysample": {
+                # Added to all the subsamples
+                "TTTo2L2Nu": {"bycategory": {"2b": [jetgood]}},
+                # Added only to the subsample
+                "TTTo2L2Nu__ee": {"bycategory": {"1b": [electron]}},
+                "DYJetsToLL": {"bycategory": {"1b": [muon]}},
+            },
+        },
+    )
+    cfg.load()
+    assert set(cfg.columns) == {"TTTo2L2Nu__ee", "TTTo2L2Nu__mumu", "DYJetsToLL"}
+    assert cfg.columns["TTTo2L2Nu__ee"] == {"1b": [jet, electron], "2b": [jet, jetgood]}
+    assert cfg.columns["TTTo2L2Nu__mumu"] == {"1b": [jet], "2b": [jet, jetgood]}
+    assert cfg.columns["DYJetsToLL"] == {"1b": [jet, muon], "2b": [jet]}
+
+
+@pytest.mark.parametrize("save_json, save_pkl", [(True, True), (False, True), (True, False)])
+def test_save_config(make_configurator, tmp_path, save_json, save_pkl):
+    cfg = make_configurator()
+    cfg.load()
+    output = tmp_path / "output"
+    output.mkdir()
+    cfg.save_config(str(output), save_json=save_json, save_pkl=save_pkl)
+    assert (output / "parameters_dump.yaml").exists()
+    assert (output / "config.json").exists() == save_json
+    assert (output / "configurator.pkl").exists() == save_pkl
+
+
+@pytest.mark.parametrize("dump", ["_json_dump_stdlib", "_json_dump_orjson"])
+def test_json_dump_roundtrip(tmp_path, dump):
+    if dump == "_json_dump_orjson":
+        pytest.importorskip("orjson")
+    import numpy as np
+
+    data = {
+        "cut": {"params": {"pt": 30.0, "max": float("inf"), "min": float("-inf"), "x": float("nan")}},
+        "bins": [0.0, 1.5, float("inf")],
+        "edges": np.array([0.0, np.inf, 2.0]),
+        "names": ("a", "b"),
+        "scalars": [np.float32(0.5), np.float32("nan"), np.int64(3), np.bool_(True), np.float64("-inf")],
+    }
+    path = tmp_path / "config.json"
+    with open(path, "wb") as f:
+        getattr(configurator, dump)(data, f)
+    # Non-finite floats are always dumped as null: the output is valid json in both cases
+    assert json.loads(path.read_text()) == {
+        "cut": {"params": {"pt": 30.0, "max": None, "min": None, "x": None}},
+        "bins": [0.0, 1.5, None],
+        "edges": [0.0, None, 2.0],
+        "names": ["a", "b"],
+        "scalars": [0.5, None, 3, True, None],
+    }
+
+
+def test_load_cache(make_configurator, tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    cfg = make_configurator()
+    key = cfg.inputs_hash()
+    cfg.load(cache_dir=str(cache_dir))
+    # Only the cache file is left in the folder
+    cache_files = os.listdir(cache_dir)
+    assert cache_files == [f"configurator_{key}.pkl"]
+
+    # The second load must be restored from the cache without parsing the inputs again
+    def fail(self):
+        raise AssertionError("The configuration has not been restored from the cache")
+
+    monkeypatch.setattr(Configurator, "load_datasets", fail)
+    cached = make_configurator()
+    cached.load(cache_dir=str(cache_dir))
+    assert cached.loaded
+    assert cached.samples == cfg.samples
+    assert cached.weights_config == cfg.weights_config
+    assert cached.weights_config["TTTo2L2Nu"]["bycategory"]["2b"] == ["sf_btag"]
+    assert os.listdir(cache_dir) == cache_files
+
+
+def test_load_cache_write_error(make_configurator, tmp_path, monkeypatch):
+    def fail(obj, f):
+        f.write(b"partial")
+        raise TypeError("cannot pickle")
+
+    monkeypatch.setattr(configurator.cloudpickle, "dump", fail)
+    cache_dir = tmp_path / "cache"
+    with pytest.raises(TypeError, match="cannot pickle"):
+        make_configurator().load(cache_dir=str(cache_dir))
+    # Neither the cache nor the temporary file are left in the folder
+    assert os.listdir(cache_dir) == []
+
+def test_inputs_hash(make_configurator, monkeypatch):
+    def categories():
+        return {"1b": [Cut("1b", {"n": 1}, passthrough.function)], "2b": [Cut("2b", {"n": 2}, passthrough.function)]}
+
+    cfg = make_configurator(categories=categories())
+    # The Cut ids contain an address-based hash: they are not part of the key
+    for cut in cfg.categories_cfg["2b"]:
+        cut._id = "changed"
+    assert cfg.inputs_hash() == make_configurator(categories=categories()).inputs_hash()
+    assert cfg.inputs_hash() != make_configurator(
+        categories=categories(), variations={"weights": {"common": {"inclusive": []}}}
+    ).inputs_hash()
+    # A different PocketCoffea version does not reuse the cache
+    key = cfg.inputs_hash()
+    monkeypatch.setattr(configurator, "__version__", "0.0.0")
+    assert cfg.inputs_hash() != key
+
+
+def test_inputs_hash_across_processes(tmp_path, datasets_json):
+    script = tmp_path / "config_hash.py"
+    script.write_text(
+        textwrap.dedent(
+            f'''
+            from omegaconf import OmegaConf
+            from pocket_coffea.utils.configurator import Configurator
+            from pocket_coffea.lib.cut_definition import Cut
+            from pocket_coffea.parameters.cuts import passthrough
+
+            class Workflow:
+                pass
+
+            def nbjets(events, params, **kwargs):
+                return events.nBJetGood >= params["n"]
+
+            cfg = Configurator(
+                workflow=Workflow,
+                parameters=OmegaConf.create({{"jets_calibration": {{"factory_file": "jets_calibrator.pkl.gz"}}}}),
+                datasets={{"jsons": [{datasets_json!r}]}},
+                skim=[passthrough],
+                preselections=[],
+                categories={{
+                    "1b": [Cut("1b", {{"n": 1}}, nbjets)],
+                    "2b": [Cut("2b", {{"n": 2}}, nbjets)],
+                }},
+                weights={{"common": {{"inclusive": {{"genWeight", "pileup", "sf_btag"}}}}}},
+                variations={{"weights": {{"common": {{"inclusive": ["pileup"]}}}}}},
+                variables={{}},
+            )
+            print(cfg.inputs_hash())
+            '''
+        )
+    )
+    hashes = set()
+    for seed in ["0", "1", "2"]:
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        out = subprocess.run([sys.executable, str(script)], env=env, capture_output=True, text=True, check=True)
+        hashes.add(out.stdout.strip())
+    assert len(hashes) == 1
+
+
+def test_inputs_hash_referenced_code(make_configurator, tmp_path, monkeypatch):
+    # Cut function defined in a config module, using a helper and a constant of another module
+    (tmp_path / "cache_test_helpers.py").write_text("THRESHOLD = 30\n\ndef above(x):\n    return x > THRESHOLD\n")
+    (tmp_path / "cache_test_cuts.py").write_text(
+        "from cache_test_helpers import above\n\n"
+        "def jets_cut(events, params, **kwargs):\n    return above(events.JetGood.pt)\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    cuts = importlib.import_module("cache_test_cuts")
+    categories = {"1b": [Cut("jets", {}, cuts.jets_cut)], "2b": [passthrough]}
+    key = make_configurator(categories=categories).inputs_hash()
+    assert make_configurator(categories=categories).inputs_hash() == key
+
+    # Editing the helper module changes the key, also without reloading the modules
+    (tmp_path / "cache_test_helpers.py").write_text("THRESHOLD = 40\n\ndef above(x):\n    return x > THRESHOLD\n")
+    assert make_configurator(categories=categories).inputs_hash() != key
+
+
+def test_inputs_hash_closures_and_defaults(make_configurator):
+    def make_cut(threshold):
+        def cut(events, params, scale=1.0, **kwargs):
+            return events.pt * scale > threshold
+        return cut
+
+    def key(function):
+        return make_configurator(categories={"1b": [Cut("pt", {}, function)], "2b": [passthrough]}).inputs_hash()
+
+    assert key(make_cut(30)) == key(make_cut(30))
+    assert key(make_cut(30)) != key(make_cut(40))
+    cut = make_cut(30)
+    cut_scaled = make_cut(30)
+    cut_scaled.__defaults__ = (2.0,)
+    assert key(cut) != key(cut_scaled)
+
+
+def test_load_uncacheable(make_configurator, tmp_path, capsys):
+    # A function whose source cannot be read, e.g. defined in a notebook
+    namespace = {"__name__": "__main__"}
+    exec(compile("def cut(events, params, **kwargs):\n    return events.pt > 30\n", "<notebook>", "exec"), namespace)
+    cfg = make_configurator(categories={"1b": [Cut("pt", {}, namespace["cut"])], "2b": [passthrough]})
+    with pytest.raises(configurator._UncacheableInput):
+        cfg.inputs_hash()
+    cache_dir = tmp_path / "cache"
+    cfg.load(cache_dir=str(cache_dir))
+    assert cfg.loaded
+    assert "The Configurator cannot be cached: the source of the function __main__.cut cannot be read" in capsys.readouterr().out
+    assert not cache_dir.exists()
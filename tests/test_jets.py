@@ -0,0 +1,229 @@
+import copy
+import pytest
+import numpy as np
+import awkward as ak
+import correctionlib
+import correctionlib.schemav2 as cs
+
+from pocket_coffea.lib import jets as jets_module
+from pocket_coffea.lib.jets import add_jec_variables, jet_correction_correctionlib
+from pocket_coffea.lib.correctionlib_utils import load_correctionset
+
+
+class Events(ak.Array):
+    '''Plain awkward events with the chunk metadata of NanoEvents'''
+    metadata = None
+
+
+def formula(name, inputs, expression, variables):
+    return cs.Correction(
+        name=name,
+        version=1,
+        inputs=[cs.Variable(name=i, type="real") for i in inputs],
+        output=cs.Variable(name="correction", type="real"),
+        data=cs.Formula(nodetype="formula", expression=expression, parser="TFormula", variables=variables),
+    )
+
+
+@pytest.fixture
+def jerc_file(tmp_path):
+    '''Toy JEC (L1 and L2 in a compound correction) and JER corrections'''
+    l1 = formula("V_L1FastJet_AK4PFchs", ["JetA", "JetEta", "JetPt", "Rho"], "1-0.02*x*y/z", ["Rho", "JetA", "JetPt"])
+    l2 = formula("V_L2Relative_AK4PFchs", ["JetEta", "JetPt"], "1.1-0.05*x+0.0001*y", ["JetEta", "JetPt"])
+    resolution = formula(
+        "R_PtResolution_AK4PFchs", ["JetEta", "JetPt", "Rho"], "0.1+0.01*x*x+0.001*z-0.0001*y", ["JetEta", "JetPt", "Rho"]
+    )
+    scale_factor = cs.Correction(
+        name="R_ScaleFactor_AK4PFchs",
+        version=1,
+        inputs=[cs.Variable(name="JetEta", type="real"), cs.Variable(name="systematic", type="string")],
+        output=cs.Variable(name="correction", type="real"),
+        data=cs.Category(
+            nodetype="category",
+            input="systematic",
+            content=[
+                cs.CategoryItem(
+                    key="nom",
+                    value=cs.Binning(
+                        nodetype="binning", input="JetEta", edges=[-5.0, 0.0, 5.0], content=[1.1, 1.3], flow="clamp"
+                    ),
+                )
+            ],
+        ),
+    )
+    compound = cs.CompoundCorrection(
+        name="V_L1L2L3Res_AK4PFchs",
+        inputs=[cs.Variable(name=i, type="real") for i in ["JetA", "JetEta", "JetPt", "Rho"]],
+        output=cs.Variable(name="correction", type="real"),
+        inputs_update=["JetPt"],
+        input_op="*",
+        output_op="*",
+        stack=["V_L1FastJet_AK4PFchs", "V_L2Relative_AK4PFchs"],
+    )
+    cset = cs.CorrectionSet(
+        schema_version=2,
+        corrections=[l1, l2, resolution, scale_factor],
+        compound_corrections=[compound],
+    )
+    path = tmp_path / "jet_jerc.json"
+    path.write_text(cset.json(exclude_unset=True))
+    return str(path)
+
+
+@pytest.fixture
+def events():
+    '''Events with 2, 0 and 3 jets: matched, unmatched and out of range genJetIdx'''
+    events = Events(
+        {
+            "event": [12345, 12346, 12347],
+            "fixedGridRhoFastjetAll": [20.0, 15.0, 31.0],
+            "Jet": [
+                [
+                    {"pt": 80.0, "mass": 10.0, "eta": 0.5, "phi": 0.1, "rawFactor": 0.1, "area": 0.5, "genJetIdx": 0},
+                    {"pt": 35.0, "mass": 5.0, "eta": -1.5, "phi": 2.1, "rawFactor": 0.2, "area": 0.4, "genJetIdx": -1},
+                ],
+                [],
+                [
+                    {"pt": 120.0, "mass": 15.0, "eta": -0.3, "phi": -2.0, "rawFactor": 0.05, "area": 0.5, "genJetIdx": 1},
+                    {"pt": 50.0, "mass": 7.0, "eta": 2.2, "phi": 1.0, "rawFactor": 0.15, "area": 0.6, "genJetIdx": 5},
+                    {"pt": 25.0, "mass": 3.0, "eta": 1.0, "phi": -0.5, "rawFactor": 0.0, "area": 0.45, "genJetIdx": 0},
+                ],
+            ],
+            "GenJet": [
+                [{"pt": 78.0, "eta": 0.5, "phi": 0.1, "mass": 9.0}],
+                [],
+                [{"pt": 10.0, "eta": 1.0, "phi": -0.5, "mass": 2.0}, {"pt": 115.0, "eta": -0.3, "phi": -2.0, "mass": 14.0}],
+            ],
+        }
+    )
+    events.metadata = {"filename": "test.root", "entrystart": 0, "entrystop": 3}
+    return events
+
+
+def jet_correction_correctionlib_reference(events, Jet, typeJet, jsonfile, JECversion, JERversion=None):
+    '''Previous implementation, flattening all the jet columns and copying the jets'''
+    JECfile = correctionlib.CorrectionSet.from_file(jsonfile)
+    corr = JECfile.compound[f'{JECversion}_L1L2L3Res_{typeJet}']
+
+    jets = events[Jet]
+    jets['pt_raw'] = (1 - jets['rawFactor']) * jets['pt']
+    jets['mass_raw'] = (1 - jets['rawFactor']) * jets['mass']
+    jets['rho'] = ak.broadcast_arrays(events.fixedGridRhoFastjetAll, jets.pt)[0]
+    j, nj = ak.flatten(jets), ak.num(jets)
+    flatCorrFactor = corr.evaluate(
+        np.array(j['area']),
+        np.array(j['eta']),
+        np.array(j['pt_raw']),
+        np.array(j['rho']),
+    )
+    corrFactor = ak.unflatten(flatCorrFactor, nj)
+
+    jets_corrected = copy.copy(jets)
+    jets_corrected['pt'] = jets['pt_raw'] * corrFactor
+    jets_corrected['mass'] = jets['mass_raw'] * corrFactor
+    jets_corrected['rho'] = jets['rho']
+
+    seed = events.event[0]
+    if not JERversion:
+        return jets_corrected
+
+    sf = JECfile[f'{JERversion}_ScaleFactor_{typeJet}']
+    res = JECfile[f'{JERversion}_PtResolution_{typeJet}']
+    j, nj = ak.flatten(jets_corrected), ak.num(jets_corrected)
+    scaleFactor_flat = sf.evaluate(j['eta'].to_numpy(), 'nom')
+    ptResolution_flat = res.evaluate(j['eta'].to_numpy(), j['pt'].to_numpy(), j['rho'].to_numpy())
+    scaleFactor = ak.unflatten(scaleFactor_flat, nj)
+    ptResolution = ak.unflatten(ptResolution_flat, nj)
+    pt_min = 3 * ptResolution * jets_corrected['pt']
+    genjets = events['GenJet']
+    Ngenjet = ak.num(genjets)
+    matched_genjets_idx = ak.mask(
+        jets_corrected['genJetIdx'],
+        (jets_corrected['genJetIdx'] < Ngenjet) & (jets_corrected['genJetIdx'] != -1),
+    )
+    matched_objs_mask = ~ak.is_none(matched_genjets_idx, axis=1)
+    matched_genjets = genjets[matched_genjets_idx]
+    matched_jets = ak.mask(jets_corrected, matched_objs_mask)
+    deltaPt = ak.unflatten(
+        np.abs(ak.flatten(matched_jets.pt) - ak.flatten(matched_genjets.pt)),
+        ak.num(matched_genjets),
+    )
+    matched_genjets = ak.mask(matched_genjets, deltaPt < pt_min)
+    matched_jets = ak.mask(matched_jets, deltaPt < pt_min)
+    detSmear = 1 + (scaleFactor - 1) * (matched_jets['pt'] - matched_genjets['pt']) / matched_jets['pt']
+    np.random.seed(seed)
+    filename = events.metadata['filename']
+    entrystart = events.metadata['entrystart']
+    entrystop = events.metadata['entrystop']
+    seed_dict = {f'chunk_{filename}_{entrystart}-{entrystop}': seed}
+    rand_gaus = np.random.normal(np.zeros_like(ptResolution_flat), ptResolution_flat)
+    jersmear = ak.unflatten(rand_gaus, nj)
+    sqrt_arg_flat = scaleFactor_flat**2 - 1
+    sqrt_arg_flat = ak.where(sqrt_arg_flat > 0, sqrt_arg_flat, ak.zeros_like(sqrt_arg_flat))
+    sqrt_arg = ak.unflatten(sqrt_arg_flat, nj)
+    stochSmear = 1 + jersmear * np.sqrt(sqrt_arg)
+    isMatched = ~ak.is_none(matched_jets.pt, axis=1)
+    smearFactor = ak.where(isMatched, detSmear, stochSmear)
+    jets_smeared = copy.copy(jets_corrected)
+    jets_smeared['pt'] = jets_corrected['pt'] * smearFactor
+    jets_smeared['mass'] = jets_corrected['mass'] * smearFactor
+    return jets_smeared, seed_dict
+
+
+def assert_same_jets(jets, reference):
+    assert set(ak.fields(jets)) == set(ak.fields(reference))
+    assert ak.to_list(ak.num(jets)) == ak.to_list(ak.num(reference))
+    for var in ["pt", "mass", "pt_raw", "mass_raw", "rho", "eta"]:
+        assert np.allclose(ak.to_numpy(ak.flatten(jets[var])), ak.to_numpy(ak.flatten(reference[var]))), var
+
+
+def test_jet_correction_correctionlib_jec(jerc_file, events, monkeypatch):
+    monkeypatch.setattr(jets_module, "JECjsonFiles", {"2018": {"AK4": jerc_file}})
+    corrected = jet_correction_correctionlib(events, "Jet", "AK4PFchs", "2018", "V")
+    reference = jet_correction_correctionlib_reference(events, "Jet", "AK4PFchs", jerc_file, "V")
+    assert_same_jets(corrected, reference)
+    # The correction is applied on the raw pt and mass
+    assert not np.allclose(ak.to_numpy(ak.flatten(corrected.pt)), ak.to_numpy(ak.flatten(corrected.pt_raw)))
+    assert ak.to_list(corrected.rho) == [[20.0, 20.0], [], [31.0, 31.0, 31.0]]
+
+
+def test_jet_correction_correctionlib_jer(jerc_file, events, monkeypatch):
+    monkeypatch.setattr(jets_module, "JECjsonFiles", {"2018": {"AK4": jerc_file}})
+    smeared, seed_dict = jet_correction_correctionlib(events, "Jet", "AK4PFchs", "2018", "V", JERversion="R")
+    reference, reference_seed_dict = jet_correction_correctionlib_reference(
+        events, "Jet", "AK4PFchs", jerc_file, "V", JERversion="R"
+    )
+    assert seed_dict == reference_seed_dict
+    assert_same_jets(smeared, reference)
+    # The smearing modifies the JEC corrected pt
+    jec = jet_correction_correctionlib(events, "Jet", "AK4PFchs", "2018", "V")
+    assert not np.allclose(ak.to_numpy(ak.flatten(smeared.pt)), ak.to_numpy(ak.flatten(jec.pt)))
+
+
+@pytest.mark.parametrize("isMC", [True, False])
+def test_add_jec_variables(events, isMC):
+    jets = events.Jet
+    if isMC:
+        jets["matched_gen"] = ak.Array([[{"pt": 78.0}, None], [], [None, None, {"pt": 10.0}]])
+    rho = events.fixedGridRhoFastjetAll
+    jets = add_jec_variables(jets, rho, isMC=isMC)
+    # rho is repeated for each jet, also after events with zero jets
+    assert ak.to_list(jets.event_rho) == ak.to_list(ak.broadcast_arrays(rho, jets.pt)[0])
+    assert ak.to_list(jets.event_rho) == [[20.0, 20.0], [], [31.0, 31.0, 31.0]]
+    assert np.allclose(ak.to_numpy(ak.flatten(jets.pt_raw)), [72.0, 28.0, 114.0, 42.5, 25.0])
+    if isMC:
+        assert ak.to_list(jets.pt_gen) == [[78.0, 0.0], [], [0.0, 0.0, 10.0]]
+
+
+def test_add_jec_variables_no_jets():
+    empty = ak.unflatten(np.zeros(0), [0, 0, 0])
+    jets = ak.zip({"pt": empty, "mass": empty, "rawFactor": empty})
+    jets = add_jec_variables(jets, ak.Array([1.0, 2.0, 3.0]), isMC=False)
+    assert ak.to_list(jets.event_rho) == [[], [], []]
+
+
+def test_load_correctionset(jerc_file):
+    # The CorrectionSet is parsed once and shared by the following calls
+    cset = load_correctionset(jerc_file)
+    assert load_correctionset(jerc_file) is cset
+    assert "R_ScaleFactor_AK4PFchs" in cset
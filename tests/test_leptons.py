@@ -0,0 +1,208 @@
+import pytest
+import numpy as np
+import awkward as ak
+from coffea.nanoevents.methods import candidate
+from omegaconf import OmegaConf
+
+from pocket_coffea.lib.leptons import get_charged_leptons, get_dilepton, lepton_selection
+
+
+def make_leptons(pt, eta, phi, charge):
+    return ak.zip(
+        {
+            "pt": pt,
+            "eta": eta,
+            "phi": phi,
+            "mass": ak.zeros_like(pt),
+            "charge": charge,
+        },
+        with_name="PtEtaPhiMCandidate",
+        behavior=candidate.behavior,
+    )
+
+
+# Events: ee, mumu, e+mu-, e-mu+, ee not passing the mask, e+e-mu+ (3 leptons)
+electrons = make_leptons(
+    pt=ak.Array([[50.0, 40.0], [], [35.0], [45.0], [60.0, 30.0], [55.0, 25.0]]),
+    eta=ak.Array([[0.5, -1.2], [], [1.1], [-0.3], [0.2, 0.4], [1.5, -2.0]]),
+    phi=ak.Array([[0.1, 2.5], [], [-1.0], [3.0], [0.7, -0.7], [1.2, -2.2]]),
+    charge=ak.Array([[1, -1], [], [1], [-1], [1, -1], [1, -1]]),
+)
+muons = make_leptons(
+    pt=ak.Array([[], [70.0, 20.0], [65.0], [28.0], [], [33.0]]),
+    eta=ak.Array([[], [-0.8, 2.1], [0.9], [-1.7], [], [0.6]]),
+    phi=ak.Array([[], [1.9, -0.4], [-2.8], [0.3], [], [2.9]]),
+    charge=ak.Array([[], [-1, 1], [-1], [1], [], [1]]),
+)
+mask = ak.Array([True, True, True, True, False, True])
+
+fields = ["pt", "eta", "phi", "mass", "energy", "charge", "x", "y", "z"]
+
+
+def get_charged_leptons_reference(electrons, muons, charge, mask):
+    '''Previous implementation, with four sequential ak.where for each field'''
+    nelectrons = ak.num(electrons)
+    nmuons = ak.num(muons)
+    mask_ee = mask & ((nelectrons + nmuons) == 2) & (nelectrons == 2)
+    mask_mumu = mask & ((nelectrons + nmuons) == 2) & (nmuons == 2)
+    mask_emu = mask & ((nelectrons + nmuons) == 2) & (nelectrons == 1) & (nmuons == 1)
+
+    out = {}
+    for var in fields:
+        if var in ["eta", "phi"]:
+            default = ak.from_iter(len(electrons) * [[-9.0]])
+        else:
+            default = ak.from_iter(len(electrons) * [[-999.9]])
+        out[var] = ak.where(mask_ee, getattr(electrons, var)[electrons.charge == charge], default)
+        out[var] = ak.where(mask_mumu, getattr(muons, var)[muons.charge == charge], out[var])
+        out[var] = ak.where(
+            mask_emu & ak.any(electrons.charge == charge, axis=1),
+            getattr(electrons, var)[electrons.charge == charge],
+            out[var],
+        )
+        out[var] = ak.where(
+            mask_emu & ak.any(muons.charge == charge, axis=1),
+            getattr(muons, var)[muons.charge == charge],
+            out[var],
+        )
+        out[var] = ak.flatten(out[var])
+    return out
+
+
+@pytest.mark.parametrize("charge", [1, -1])
+def test_get_charged_leptons(charge):
+    charged_leptons = get_charged_leptons(electrons, muons, charge, mask)
+    reference = get_charged_leptons_reference(electrons, muons, charge, mask)
+    for var in fields:
+        # The stored fields are compared: energy, x, y, z are also behavior properties
+        assert np.allclose(
+            ak.to_numpy(charged_leptons[var]), ak.to_numpy(reference[var])
+        ), var
+
+    # Events not passing the mask or with 3 leptons get the default values
+    for i in [4, 5]:
+        assert charged_leptons.pt[i] == -999.9
+        assert charged_leptons.eta[i] == -9.0
+        assert charged_leptons.phi[i] == -9.0
+
+
+def test_get_charged_leptons_flavour():
+    positive = get_charged_leptons(electrons, muons, 1, mask)
+    # ee, mumu, e+mu-, e-mu+
+    assert ak.to_list(positive.pt[:4]) == [50.0, 20.0, 35.0, 28.0]
+    negative = get_charged_leptons(electrons, muons, -1, mask)
+    assert ak.to_list(negative.pt[:4]) == [40.0, 70.0, 65.0, 45.0]
+
+
+selection_events = ak.zip(
+    {
+        "Electron": ak.zip(
+            {
+                "pt": [[50.0, 12.0, 30.0], [], [25.0, 40.0]],
+                "eta": [[0.5, 1.0, -1.5], [], [2.6, -0.1]],
+                "deltaEtaSC": [[0.01, 0.0, 0.02], [], [0.0, -0.01]],
+                "pfRelIso03_all": [[0.05, 0.01, 0.02], [], [0.01, 0.3]],
+                "mvaFall17V2Iso_WP80": [[True, True, True], [], [True, True]],
+            }
+        ),
+        "Muon": ak.zip(
+            {
+                "pt": [[30.0], [45.0, 8.0, 26.0], []],
+                "eta": [[2.5], [0.3, 0.1, -1.9], []],
+                "pfRelIso04_all": [[0.1], [0.1, 0.1, 0.3], []],
+                "tightId": [[True], [True, True, False], []],
+            }
+        ),
+    },
+    depth_limit=1,
+)
+
+
+def lepton_selection_reference(events, lepton_flavour, params):
+    '''Previous implementation, evaluating the cuts on the jagged arrays'''
+    leptons = events[lepton_flavour]
+    cuts = params.object_preselection[lepton_flavour]
+    passes_eta = abs(leptons.eta) < cuts["eta"]
+    passes_pt = leptons.pt > cuts["pt"]
+    if lepton_flavour == "Electron":
+        etaSC = abs(leptons.deltaEtaSC + leptons.eta)
+        passes_SC = np.invert((etaSC >= 1.4442) & (etaSC <= 1.5660))
+        passes_iso = True
+        if "iso" in cuts.keys():
+            passes_iso = leptons.pfRelIso03_all < cuts["iso"]
+        passes_id = leptons[cuts['id']] == True
+        good_leptons = passes_eta & passes_pt & passes_SC & passes_iso & passes_id
+    elif lepton_flavour == "Muon":
+        passes_iso = leptons.pfRelIso04_all < cuts["iso"]
+        passes_id = leptons[cuts['id']] == True
+        good_leptons = passes_eta & passes_pt & passes_iso & passes_id
+    return leptons[good_leptons]
+
+
+@pytest.mark.parametrize(
+    "lepton_flavour, cuts",
+    [
+        ("Electron", {"pt": 15, "eta": 2.5, "iso": 0.06, "id": "mvaFall17V2Iso_WP80"}),
+        ("Electron", {"pt": 15, "eta": 2.5, "id": "mvaFall17V2Iso_WP80"}),
+        ("Muon", {"pt": 15, "eta": 2.4, "iso": 0.15, "id": "tightId"}),
+    ],
+)
+def test_lepton_selection(lepton_flavour, cuts):
+    params = OmegaConf.create({"object_preselection": {lepton_flavour: cuts}})
+    selected = lepton_selection(selection_events, lepton_flavour, params)
+    reference = lepton_selection_reference(selection_events, lepton_flavour, params)
+    assert ak.to_list(selected) == ak.to_list(reference)
+    assert ak.to_list(ak.num(selected)) == ak.to_list(ak.num(reference))
+
+
+def get_dilepton_reference(electrons, muons, transverse=False):
+    '''Previous implementation, counting the leptons after padding'''
+    fields = {
+        "pt": 0.,
+        "eta": 0.,
+        "phi": 0.,
+        "mass": 0.,
+        "charge": 0.,
+    }
+    leptons = ak.pad_none(ak.with_name(ak.concatenate([muons[:, 0:2], electrons[:, 0:2]], axis=1), "PtEtaPhiMCandidate"), 2)
+    nlep = ak.num(leptons[~ak.is_none(leptons, axis=1)])
+    ll = leptons[:, 0] + leptons[:, 1]
+    for var in fields.keys():
+        fields[var] = ak.where((nlep == 2), getattr(ll, var), fields[var])
+    fields["deltaR"] = ak.where((nlep == 2), leptons[:, 0].delta_r(leptons[:, 1]), -1)
+    fields["deltaPhi"] = ak.where((nlep == 2), abs(leptons[:, 0].delta_phi(leptons[:, 1])), -1)
+    fields["deltaEta"] = ak.where((nlep == 2), abs(leptons[:, 0].eta - leptons[:, 1].eta), -1)
+    fields["l1phi"] = ak.where((nlep == 2), leptons[:, 0].phi, -1)
+    fields["l2phi"] = ak.where((nlep == 2), leptons[:, 1].phi, -1)
+    if transverse:
+        fields["eta"] = ak.zeros_like(fields["pt"])
+    return ak.zip(fields, with_name="PtEtaPhiMCandidate")
+
+
+# Events with 0, 1 (e), 1 (mu), 2 (ee), 2 (mumu), 2 (emu), 3 (eemu) and 4 (eemumu) leptons
+dilepton_electrons = make_leptons(
+    pt=ak.Array([[], [40.0], [], [50.0, 30.0], [], [35.0], [55.0, 25.0], [60.0, 20.0]]),
+    eta=ak.Array([[], [0.3], [], [0.5, -1.2], [], [1.1], [1.5, -2.0], [0.2, 0.4]]),
+    phi=ak.Array([[], [1.0], [], [0.1, 2.5], [], [-1.0], [1.2, -2.2], [0.7, -0.7]]),
+    charge=ak.Array([[], [1], [], [1, -1], [], [1], [1, -1], [1, -1]]),
+)
+dilepton_muons = make_leptons(
+    pt=ak.Array([[], [], [45.0], [], [70.0, 20.0], [65.0], [33.0], [28.0, 15.0]]),
+    eta=ak.Array([[], [], [-0.6], [], [-0.8, 2.1], [0.9], [0.6], [-1.7, 1.3]]),
+    phi=ak.Array([[], [], [2.0], [], [1.9, -0.4], [-2.8], [2.9], [0.3, -3.0]]),
+    charge=ak.Array([[], [], [-1], [], [-1, 1], [-1], [1], [1, -1]]),
+)
+
+
+@pytest.mark.parametrize("transverse", [False, True])
+def test_get_dilepton(transverse):
+    dileptons = get_dilepton(dilepton_electrons, dilepton_muons, transverse=transverse)
+    reference = get_dilepton_reference(dilepton_electrons, dilepton_muons, transverse=transverse)
+    assert ak.fields(dileptons) == ak.fields(reference)
+    for var in ak.fields(reference):
+        assert ak.to_list(dileptons[var]) == ak.to_list(reference[var]), var
+
+    # Only the events with exactly two leptons have a dilepton
+    has_dilepton = [False, False, False, True, True, True, False, False]
+    assert ak.to_list(dileptons.deltaR > 0) == has_dilepton
+    assert ak.to_list(dileptons["pt"][~np.array(has_dilepton)]) == [0.0] * 5
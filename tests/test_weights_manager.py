@@ -0,0 +1,203 @@
+import pytest
+import numpy as np
+import awkward as ak
+from omegaconf import OmegaConf
+from coffea.analysis_tools import Weights
+
+from pocket_coffea.lib import weights_manager as weights_manager_module
+from pocket_coffea.lib.weights_manager import WeightsManager, WeightCustom, _rescale_variations
+
+size = 4
+metadata = {"sample": "TTTo2L2Nu", "dataset": "TTTo2L2Nu_2018", "year": "2018", "xsec": 1.0}
+
+w_incl = np.array([1.0, 2.0, 3.0, 4.0])
+w_bycat = np.array([0.5, 0.5, 2.0, 2.0])
+
+
+def weight_function(name, nominal, up=None, down=None):
+    if up is None:
+        return WeightCustom(name=name, function=lambda params, events, size, metadata, shape_variation: [(name, nominal)])
+    return WeightCustom(
+        name=name,
+        function=lambda params, events, size, metadata, shape_variation: [(name, nominal, up, down)],
+    )
+
+
+@pytest.fixture
+def weights_manager():
+    '''
+    - "incl": inclusive weight, with variations available only inclusively
+    - "cat": weight of the category "2b", with variations available only in the category
+    - "shared": variations available both inclusively and in the category "2b"
+    The category "1b" has no bycategory weights.
+    '''
+    weightsConf = {
+        "inclusive": [
+            weight_function("incl", w_incl, w_incl * 1.1, w_incl * 0.9),
+            weight_function("shared", np.ones(size), np.full(size, 1.2), np.full(size, 0.8)),
+        ],
+        "bycategory": {
+            "1b": [],
+            "2b": [
+                weight_function("cat", w_bycat, w_bycat * 1.5, w_bycat * 0.5),
+                weight_function("shared", np.ones(size), np.full(size, 1.3), np.full(size, 0.7)),
+            ],
+        },
+        "is_split_bycat": True,
+    }
+    return WeightsManager({}, weightsConf, size, events=None, shape_variation="nominal", metadata=metadata)
+
+
+def test_inclusive_weight(weights_manager):
+    assert np.allclose(weights_manager.get_weight(), w_incl)
+    assert np.allclose(weights_manager.get_weight(modifier="inclUp"), w_incl * 1.1)
+    assert np.allclose(weights_manager.get_weight(modifier="sharedDown"), w_incl * 0.8)
+
+
+def test_category_without_bycategory_weights(weights_manager):
+    # The inclusive weight is returned, also for missing categories
+    for cat in ["1b", "missing"]:
+        assert np.allclose(weights_manager.get_weight(category=cat), w_incl)
+        assert np.allclose(weights_manager.get_weight(category=cat, modifier="inclDown"), w_incl * 0.9)
+    with pytest.raises(ValueError, match="inclusive category"):
+        weights_manager.get_weight(category="1b", modifier="catUp")
+
+
+def test_category_nominal(weights_manager):
+    assert np.allclose(weights_manager.get_weight(category="2b"), w_incl * w_bycat)
+
+
+def test_modifier_only_inclusive(weights_manager):
+    assert np.allclose(
+        weights_manager.get_weight(category="2b", modifier="inclUp"), w_incl * 1.1 * w_bycat
+    )
+
+
+def test_modifier_only_bycategory(weights_manager):
+    assert np.allclose(
+        weights_manager.get_weight(category="2b", modifier="catDown"), w_incl * w_bycat * 0.5
+    )
+    with pytest.raises(ValueError, match="inclusive category"):
+        weights_manager.get_weight(modifier="catDown")
+
+
+def test_modifier_inclusive_and_bycategory(weights_manager):
+    with pytest.raises(ValueError, match="not available in category 2b"):
+        weights_manager.get_weight(category="2b", modifier="sharedUp")
+
+
+def test_unknown_modifier(weights_manager):
+    with pytest.raises(ValueError, match="inclusive category"):
+        weights_manager.get_weight(modifier="unknownUp")
+    with pytest.raises(ValueError, match="not available in category 2b"):
+        weights_manager.get_weight(category="2b", modifier="unknownUp")
+
+
+def test_custom_weight_columns():
+    events = ak.Array(
+        {
+            "fixedGridRhoFastjetAll": [10.0, 20.0, 30.0, 40.0],
+            "nJet": [1, 2, 0, 3],
+            "Jet_pt": [[30.0], [40.0, 50.0], [], [60.0, 70.0, 80.0]],
+        }
+    )
+    received = {}
+
+    def rho_weight(params, events, size, metadata, shape_variation):
+        received.update(events)
+        return [("rho", events["fixedGridRhoFastjetAll"] / 10.0)]
+
+    weightsConf = {
+        "inclusive": [WeightCustom(name="rho", function=rho_weight, columns=["fixedGridRhoFastjetAll", "nJet"])],
+        "bycategory": {},
+        "is_split_bycat": False,
+    }
+    wm = WeightsManager({}, weightsConf, size, events, shape_variation="nominal", metadata=metadata)
+    assert set(received) == {"fixedGridRhoFastjetAll", "nJet"}
+    assert all(isinstance(col, np.ndarray) for col in received.values())
+    assert np.allclose(wm.get_weight(), [1.0, 2.0, 3.0, 4.0])
+
+
+def test_custom_weight_jagged_column():
+    events = ak.Array({"Jet_pt": [[30.0], [40.0, 50.0], [], [60.0]]})
+    weightsConf = {
+        "inclusive": [
+            WeightCustom(
+                name="jet",
+                function=lambda params, events, size, metadata, shape_variation: [("jet", np.ones(size))],
+                columns=["Jet_pt"],
+            )
+        ],
+        "bycategory": {},
+        "is_split_bycat": False,
+    }
+    with pytest.raises(ValueError, match="Column Jet_pt requested by the WeightCustom jet is not a flat per-event column"):
+        WeightsManager({}, weightsConf, size, events, shape_variation="nominal", metadata=metadata)
+
+
+def make_sfs():
+    '''Multi-variation SF dictionary, with a zero central SF in the last event'''
+    return {
+        "central": [ak.Array([0.9, 1.1, 1.3, 0.0])],
+        "hf": [np.ones(size), ak.Array([1.0, 1.2, 1.4, 0.5]), ak.Array([0.8, 1.0, 1.2, 0.0])],
+        "lf": [np.ones(size), ak.Array([0.95, 1.15, 1.35, 0.1]), ak.Array([0.85, 1.05, 1.25, 0.2])],
+        "cferr1": [np.ones(size), ak.Array([0.9, 1.1, 1.3, 0.0]), ak.Array([0.9, 1.1, 1.3, 0.0])],
+    }
+
+
+def rescale_variations_reference(sfs, central, variations):
+    '''Previous implementation, dividing each variation by the central SF'''
+    for var in variations:
+        sfs[var][1] = sfs[var][1] / sfs[central][0]
+        sfs[var][2] = sfs[var][2] / sfs[central][0]
+
+
+def test_rescale_variations():
+    variations = ["hf", "lf", "cferr1"]
+    sfs, reference = make_sfs(), make_sfs()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        _rescale_variations(sfs, "central", variations)
+        rescale_variations_reference(reference, "central", variations)
+    assert ak.to_list(sfs["central"][0]) == ak.to_list(reference["central"][0])
+    for var in variations:
+        assert np.allclose(sfs[var][0], reference[var][0])
+        for i in [1, 2]:
+            # Division by a zero central SF gives inf or nan as before
+            np.testing.assert_array_equal(np.asarray(sfs[var][i]), ak.to_numpy(reference[var][i]))
+    # The variations are independent rows
+    assert not np.shares_memory(sfs["hf"][1], sfs["lf"][1])
+    assert not np.shares_memory(sfs["hf"][1], sfs["hf"][2])
+    # Without variations nothing is done
+    sfs = make_sfs()
+    _rescale_variations(sfs, "central", [])
+    assert isinstance(sfs["hf"][1], ak.Array)
+
+
+def test_sf_btag_weights(monkeypatch):
+    variations = ["hf", "lf", "cferr1"]
+    params = OmegaConf.create(
+        {"systematic_variations": {"weight_variations": {"sf_btag": {"2018": variations}}}}
+    )
+    # The sf_btag SFs are replaced by the toy ones: only the rescaling is tested
+    monkeypatch.setattr(
+        weights_manager_module, "sf_btag", lambda params, jets, year, njets, variations: make_sfs()
+    )
+    events = ak.Array({"JetGood": [[], [], [], []], "nJetGood": [0, 0, 0, 0]})
+    weightsConf = {"inclusive": ["sf_btag"], "bycategory": {}, "is_split_bycat": False}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        wm = WeightsManager(params, weightsConf, size, events, shape_variation="nominal", metadata=metadata)
+
+        # Weights built with the previous rescaling loop
+        reference_sfs = make_sfs()
+        rescale_variations_reference(reference_sfs, "central", variations)
+        reference = Weights(size)
+        for var, weights in reference_sfs.items():
+            reference.add(f"sf_btag_{var}", *weights)
+
+        np.testing.assert_array_equal(wm.get_weight(), reference.weight())
+        for var in variations:
+            for shift in ["Up", "Down"]:
+                modifier = f"sf_btag_{var}{shift}"
+                np.testing.assert_array_equal(
+                    wm.get_weight(modifier=modifier), reference.weight(modifier=modifier)
+                )